@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+
+import openpyxl
+
+from datetime import datetime, timedelta
+from json import dumps
+from typing import Callable, Dict, List, Tuple
+
+import main
+import util
+from main import DataManager, DataValidator, products, rules, resolve_order
+from util import (load_sheet_table, parse_html, use_now_data_dir, memory_usage, print_log, PatientsColumns,
+                  InspectionsColumns, MainSummaryColumns)
+
+# 兵庫県のサイトに接続せずに、DataManagerとDataValidatorの性能を測るためのスクリプト
+# 実際のファイルと同じ列の配置の、合成したExcelファイルを患者数の規模ごとに作成し、各make_xxxとcheck_xxxの所要時間と
+# メモリ確保量の最大値を計測してjsonに出力する
+#
+# python3 benchmark.py                                   # 1万人、10万人の規模で計測する
+# python3 benchmark.py --scales 1000000 --output a.json  # 100万人の規模で計測し、a.jsonに出力する
+# python3 benchmark.py --trace-memory                    # 関数ごとのメモリ確保量も計測する
+
+# 合成したExcelファイルの保存先。同じ規模、同じシードのファイルは作り直さずに使い回す
+benchmark_dir = os.path.join(os.environ.get("COVID19_WORK_DIR", "./work"), "benchmark")
+# 読み込んだテーブルなどのキャッシュの保存先。本番の./cacheを使わず、規模ごとに空にしてから計測する
+benchmark_cache_dir = os.path.join(benchmark_dir, "cache")
+# データの期間の始まりと日数
+benchmark_start = datetime(2020, 3, 1)
+benchmark_days = 730
+# 患者番号のうち、除外(欠番)にする割合
+exclude_ratio = 0.001
+# tracemallocで関数ごとのメモリ確保量を計測するかどうか
+# 計測中は処理がかなり遅くなる(特にExcelファイルの読み込み)ので、所要時間を比べる際はFalseにする
+trace_memory = False
+
+ages = [10, 20, 30, 40, 50, 60, 70, 80, "10歳未満", "10代未満", "90歳以上", "非公表", "30"]
+sexes = ["男性", "女性", "非公表"]
+residences = ["神戸市", "姫路市", "尼崎市", "明石市", "西宮市", "猪名川町", "大阪府", "県外", "調査中", "姫路市\n"]
+notes = [None, None, None, "No.3の濃厚接触者", "NO.12、N0,15・No.16\n接触", "調査中"]
+
+
+def make_patients_row(num: int, release_date: datetime, legacy: bool) -> List:
+    row = [None] * PatientsColumns.備考欄
+    row[PatientsColumns.番号 - 1] = num
+    row[PatientsColumns.発表日 - 1] = release_date
+    row[PatientsColumns.年代 - 1] = random.choice(ages)
+    row[PatientsColumns.性別 - 1] = random.choice(sexes)
+    row[PatientsColumns.管轄 - 1] = random.choice(DataValidator.jurisdictions)
+    row[PatientsColumns.居住地 - 1] = random.choice(residences)
+    row[PatientsColumns.職業 - 1] = "会社員"
+    row[PatientsColumns.発症日 - 1] = random.choice(
+        [release_date - timedelta(days=2), release_date - timedelta(days=5)] + DataValidator.onset_date_exceptions
+    )
+    # 旧ファイル形式(最後のファイル)だけ備考欄の位置が2列ずれている
+    row[PatientsColumns.備考欄 - (3 if legacy else 1)] = random.choice(notes)
+    return row
+
+
+def make_workbooks(directory: str, patients: int, files: int, seed: int) -> Tuple[List[str], str, str]:
+    # 患者データのファイル(新しい患者番号のファイルが先頭)、検査データ、サマリーのファイルを作成し、パスを返す
+    random.seed(seed)
+    os.makedirs(directory, exist_ok=True)
+    release_dates = [
+        benchmark_start + timedelta(days=(num - 1) * (benchmark_days - 1) // patients) for num in range(patients + 1)
+    ]
+    excludes = set(random.sample(range(1, patients + 1), int(patients * exclude_ratio)))
+    daily_patients = [0] * benchmark_days
+
+    patients_files = []
+    per_file = -(-patients // files)
+    for i in range(files):
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        # ファイルの先頭には表題や最終更新日時、空白行、列名などのデータ以外の行がある
+        header = [None] * 16
+        header[PatientsColumns.番号 - 1] = "新型コロナウイルスに感染した患者の状況"
+        if i == 0:
+            header[11] = benchmark_start + timedelta(days=benchmark_days - 1)
+            header[13] = "18時現在"
+        sheet.append(header)
+        sheet.append([])
+        sheet.append([None, "番号", "発表日", "年代", "性別", "管轄", "居住地", "職業", "発症日"])
+        legacy = i == files - 1
+        for num in range(patients - i * per_file, max(patients - (i + 1) * per_file, 0), -1):
+            if num in excludes:
+                # 欠番と書かれるか、5列空白になっている
+                sheet.append([None, num, "欠番" if num % 2 else None])
+                continue
+            daily_patients[(release_dates[num] - benchmark_start).days] += 1
+            sheet.append(make_patients_row(num, release_dates[num], legacy))
+        filename = os.path.join(directory, f"patients{i}.xlsx")
+        workbook.save(filename)
+        patients_files.append(filename)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([column.name for column in InspectionsColumns])
+    inspections_total = []
+    for day in range(benchmark_days):
+        official_pcr, unofficial_pcr = random.randint(0, 3000), random.randint(0, 1000)
+        unofficial_antigen = random.choice([None, random.randint(0, 500)])
+        subtotal = official_pcr + unofficial_pcr + (unofficial_antigen or 0)
+        inspections_total.append((inspections_total[-1] if inspections_total else 0) + subtotal)
+        sheet.append([
+            benchmark_start + timedelta(days=day), subtotal, official_pcr, unofficial_pcr, unofficial_antigen,
+            daily_patients[day]
+        ])
+    inspections_file = os.path.join(directory, "inspections.xlsx")
+    workbook.save(inspections_file)
+
+    # サマリーは途中の日付から始まり、入院調整中などの欄には古い行にだけ"-"が含まれる
+    # make_main_summaryは最新の行の値を使うので、後半の行は数値にしておく
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([column.name for column in MainSummaryColumns])
+    positive_total = sum(daily_patients[:benchmark_days // 4])
+    for day in range(benchmark_days // 4, benchmark_days):
+        positive_total += daily_patients[day]
+        death = positive_total // 100
+        discharged = positive_total * 9 // 10
+        severe = (positive_total - death - discharged) // 10
+        mild = positive_total - death - discharged - severe
+        row = [None] * len(MainSummaryColumns)
+        for column, value in [
+            (MainSummaryColumns.発表年月日, benchmark_start + timedelta(days=day)),
+            (MainSummaryColumns.発表時間, "18時"),
+            (MainSummaryColumns.検査実施人数, inspections_total[day]),
+            (MainSummaryColumns.感染者数, positive_total),
+            (MainSummaryColumns.陽性者数, positive_total),
+            (MainSummaryColumns.疑似症患者数, 0),
+            (MainSummaryColumns.入院中, mild + severe),
+            (MainSummaryColumns.中等症以下, mild),
+            (MainSummaryColumns.重症, severe),
+            (MainSummaryColumns.宿泊療養, 0),
+            (MainSummaryColumns.入院宿泊療養調整等, "-" if day < benchmark_days // 2 else 0),
+            (MainSummaryColumns.入院調整, 0),
+            (MainSummaryColumns.自宅療養, 0),
+            (MainSummaryColumns.その他, "-" if day < benchmark_days // 2 else 0),
+            (MainSummaryColumns.死亡, death),
+            (MainSummaryColumns.退院, discharged)
+        ]:
+            row[column - 1] = value
+        sheet.append(row)
+    summary_file = os.path.join(directory, "summary.xlsx")
+    workbook.save(summary_file)
+    return patients_files, inspections_file, summary_file
+
+
+def measure_call(func: Callable) -> Dict:
+    # 関数を1回呼び出し、所要時間(秒)と、その時点までの最大RSS(KB)を返す
+    # trace_memoryがTrueの場合は、tracemallocで計測した呼び出し中のメモリ確保量の最大値(KB)も返す
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func()
+        record = {"seconds": round(time.perf_counter() - start, 6)}
+        if trace_memory:
+            record["traced_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    record.update(max_rss_kb=memory_usage()["max_rss_kb"])
+    return record
+
+
+def run_benchmark(patients: int, files: int, seed: int) -> Dict:
+    result = {"patients": patients, "files": files}
+    directory = os.path.join(benchmark_dir, f"{patients}_{files}_{seed}")
+    if not os.path.exists(os.path.join(directory, "summary.xlsx")):
+        print_log("benchmark", f"Make workbooks of {patients} patients...")
+        make_workbooks(directory, patients, files, seed)
+
+    tables = {}
+
+    def load() -> None:
+        tables["patients"] = [
+            load_sheet_table(os.path.join(directory, f"patients{i}.xlsx")) for i in range(files)
+        ]
+        tables["inspections"] = load_sheet_table(os.path.join(directory, "inspections.xlsx"))
+        tables["summary"] = load_sheet_table(os.path.join(directory, "summary.xlsx"))
+
+    # 1回目はキャッシュのない状態でExcelファイルを読み込み、2回目はキャッシュから読み込む時間を計測する
+    shutil.rmtree(benchmark_cache_dir, ignore_errors=True)
+    print_log("benchmark", f"Load workbooks of {patients} patients...")
+    result["load_workbooks"] = measure_call(load)
+    result["load_workbooks_cached"] = measure_call(load)
+
+    managers = []
+    result["init_data_manager"] = measure_call(lambda: managers.append(DataManager(
+        tables["patients"], tables["inspections"], tables["summary"], parse_html(b"<html></html>")
+    )))
+    data_manager = managers[0]
+    # 依存先から順に生成するので、各make_xxxの計測には依存先の生成時間は含まれない
+    result["make"] = {}
+    for name in resolve_order(products, list(products)):
+        print_log("benchmark", f"Run make_{name}...")
+        result["make"][name] = measure_call(getattr(data_manager, "make_" + name))
+
+    data_validator = DataValidator(data_manager)
+    result["check"] = {}
+    for name in resolve_order(rules, list(rules)):
+        print_log("benchmark", f"Run check_{name}...")
+        result["check"][name] = measure_call(getattr(data_validator, "check_" + name))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="合成したExcelファイルを用いて、jsonの生成とデータの検証の性能を計測します")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000], help="計測する患者数")
+    parser.add_argument("--files", type=int, default=3, help="患者データのファイル数")
+    parser.add_argument("--seed", type=int, default=0, help="データを合成する際の乱数のシード")
+    parser.add_argument("--output", default="benchmark_results.json", help="計測結果の出力先")
+    parser.add_argument("--trace-memory", action="store_true", help="tracemallocで関数ごとのメモリ確保量も計測する")
+    args = parser.parse_args()
+    trace_memory = args.trace_memory
+
+    # 前回のpatients.jsonを使わずに全て作り直させ、デプロイされているjsonも取得しないようにする
+    main.patients_incremental = False
+    use_now_data_dir(os.path.join(benchmark_dir, "now_data"))
+    util.cache_dir = benchmark_cache_dir
+
+    results = {
+        "date": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "trace_memory": trace_memory,
+        "results": [run_benchmark(scale, args.files, args.seed) for scale in args.scales]
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(dumps(results, ensure_ascii=False, indent=4))
+    print_log("benchmark", f"Results are written to {args.output}")
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from typing import Dict, List
+
+# 兵庫県のサイトの代わりに、トップページと2つのデータファイルの一覧ページ、Excelファイルを配信するローカルのHTTPサーバー
+# 遅延やタイムアウト、5xxエラー、途中で切れたレスポンス、リンク切れ(404)を起こさせることができるので、
+# ダウンロード処理のリトライや並列数の変更の効果を、ネットワークに接続せずに計測できる
+#
+# python3 fixture_server.py serve --profile errors --port 8000
+# COVID19_BASE_URL=http://127.0.0.1:8000 python3 main.py fetch
+#
+# python3 fixture_server.py benchmark  # 各障害のプロファイルでfetchステージを実行し、スループットと遅延を計測する
+#
+# utilはインポート時にCOVID19_BASE_URLを読むので、main(とutil)はサーバーを起動してから関数の中でインポートする
+
+# 配信するExcelファイルの規模
+fixture_patients = 10000
+fixture_patients_files = 3
+
+
+class FaultProfile:
+    # サーバーに起こさせる障害の設定
+    # 各rateはリクエストごとにその障害を起こす確率で、latencyは全てのリクエストに加える遅延(秒)の平均
+    # missing_pathsに含まれるパスは、一覧ページにリンクがあっても404を返す(リンク切れ)
+    def __init__(self, latency: float = 0, error_rate: float = 0, timeout_rate: float = 0,
+                 truncate_rate: float = 0, missing_paths: List[str] = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.truncate_rate = truncate_rate
+        self.missing_paths = missing_paths or []
+
+
+fault_profiles = {
+    "none": FaultProfile(),
+    "latency": FaultProfile(latency=0.2),
+    "errors": FaultProfile(error_rate=0.2),
+    "timeouts": FaultProfile(timeout_rate=0.1),
+    "truncated": FaultProfile(truncate_rate=0.1),
+    "link_rot": FaultProfile(missing_paths=["/kk03/documents/patients1.xlsx"])
+}
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pages: Dict[str, bytes] = None, profile: FaultProfile = None,
+                 hang_seconds: float = 10, seed: int = 0):
+        super().__init__(address, FixtureHandler)
+        # パスと配信する内容の辞書
+        self.pages = pages or {}
+        self.profile = profile or FaultProfile()
+        # タイムアウトを起こさせる際に、応答せずに待つ時間(秒)
+        self.hang_seconds = hang_seconds
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def roll(self, rate: float) -> bool:
+        with self.random_lock:
+            return self.random.random() < rate
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # keep-aliveで接続を使い回せるようにする
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        profile = self.server.profile
+        if profile.latency:
+            with self.server.random_lock:
+                latency = profile.latency * self.server.random.uniform(0.5, 1.5)
+            time.sleep(latency)
+        path = self.path.split("?")[0]
+        content = self.server.pages.get(path)
+        if content is None or path in profile.missing_paths:
+            self.send_error(404)
+            return
+        if self.server.roll(profile.error_rate):
+            self.send_error(503)
+            return
+        if self.server.roll(profile.timeout_rate):
+            # 応答せずに待ち、クライアント側でタイムアウトさせる
+            time.sleep(self.server.hang_seconds)
+            self.close_connection = True
+            return
+        truncated = self.server.roll(profile.truncate_rate)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html" if path[-5:] == ".html" or path == "/" else
+                         "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if truncated:
+            # Content-Lengthより短いところで接続を切る
+            self.wfile.write(content[:len(content) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def make_pages(directory: str) -> Dict[str, bytes]:
+    # benchmark.pyで合成したExcelファイルと、それらへのリンクを含む一覧ページ、トップページを用意する
+    import benchmark
+    from main import patients_page, inspections_page
+
+    if not os.path.exists(os.path.join(directory, "summary.xlsx")):
+        benchmark.make_workbooks(directory, fixture_patients, fixture_patients_files, 0)
+
+    def read(filename: str) -> bytes:
+        with open(os.path.join(directory, filename), "rb") as f:
+            return f.read()
+
+    def index_page(links: List[str]) -> bytes:
+        return "".join(
+            ["<html><body>"] + [f'<a href="{link}">{os.path.basename(link)}</a>' for link in links] +
+            ["</body></html>"]
+        ).encode()
+
+    patients_links = [f"/kk03/documents/patients{i}.xlsx" for i in range(fixture_patients_files)]
+    inspections_links = ["/kf16/documents/summary.xlsx", "/kf16/documents/inspections.xlsx"]
+    pages = {
+        "/": '<html><body><p align="center"><strong>新型コロナウイルス感染症</strong></p></body></html>'.encode(),
+        patients_page: index_page(patients_links),
+        inspections_page: index_page(inspections_links)
+    }
+    for link in patients_links + inspections_links:
+        pages[link] = read(os.path.basename(link))
+    return pages
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(max(math.ceil(len(values) * q) - 1, 0), len(values) - 1)]
+
+
+def run_fetch_benchmark(server: FixtureServer, profiles: List[str], runs: int) -> List[Dict]:
+    # 各プロファイルで、毎回空の作業ディレクトリとキャッシュからfetchステージを実行し、HTTP通信の計測結果を集計する
+    import main
+    import util
+    from util import print_log
+
+    results = []
+    for name in profiles:
+        server.profile = fault_profiles[name]
+        result = {"profile": name, "runs": runs, "failed_runs": 0, "errors": []}
+        http_records = []
+        seconds = 0
+        for _ in range(runs):
+            temp_dir = tempfile.mkdtemp(prefix="covid19-fixture-")
+            main.work_dir = os.path.join(temp_dir, "work")
+            util.cache_dir = os.path.join(temp_dir, "cache")
+            util.use_now_data_dir(os.path.join(temp_dir, "now_data"))
+            util.run_report.clear()
+            util.now_data_jsons.clear()
+            print_log("fixture", f"Run fetch stage with \"{name}\" profile...")
+            start = time.perf_counter()
+            try:
+                main.fetch({})
+            except Exception as e:
+                result["failed_runs"] += 1
+                result["errors"].append(str(e))
+            seconds += time.perf_counter() - start
+            http_records += [record for record in util.run_report if record["stage"] == "http"]
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # 所要時間はリトライの待ち時間も含めた、1回のhttp_getの呼び出しにかかった時間
+        latencies = [record["seconds"] for record in http_records]
+        total_bytes = sum(record.get("bytes", 0) for record in http_records)
+        result.update(
+            seconds=round(seconds, 6),
+            requests=len(http_records),
+            retries=sum(record["retries"] for record in http_records),
+            bytes=total_bytes,
+            requests_per_second=round(len(http_records) / seconds, 3) if seconds else 0,
+            bytes_per_second=round(total_bytes / seconds, 3) if seconds else 0,
+            latency={
+                "p50": percentile(latencies, 0.5),
+                "p90": percentile(latencies, 0.9),
+                "p99": percentile(latencies, 0.99),
+                "max": max(latencies, default=0)
+            }
+        )
+        print_log(
+            "fixture",
+            f"{name}: {result['requests_per_second']} req/s, p99 {result['latency']['p99']:.3f}s, " +
+            f"{result['retries']} retries, {result['failed_runs']}/{runs} failed runs"
+        )
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="兵庫県のサイトの代わりとなる、ローカルのHTTPサーバーを起動します")
+    parser.add_argument("mode", choices=["serve", "benchmark"])
+    parser.add_argument("--port", type=int, default=0, help="待ち受けるポート(0なら空いているポート)")
+    parser.add_argument("--profile", choices=list(fault_profiles), default="none", help="serveで起こさせる障害")
+    parser.add_argument("--profiles", choices=list(fault_profiles), nargs="+", default=list(fault_profiles),
+                        help="benchmarkで計測する障害")
+    parser.add_argument("--runs", type=int, default=3, help="benchmarkでプロファイルごとにfetchステージを実行する回数")
+    parser.add_argument("--read-timeout", type=float, default=5, help="benchmarkでの読み込みのタイムアウト(秒)")
+    parser.add_argument("--output", default="fixture_results.json", help="benchmarkの計測結果の出力先")
+    args = parser.parse_args()
+
+    fixture_server = FixtureServer(
+        ("127.0.0.1", args.port), profile=fault_profiles[args.profile], hang_seconds=args.read_timeout + 1
+    )
+    os.environ["COVID19_BASE_URL"] = f"http://127.0.0.1:{fixture_server.server_port}"
+    fixture_server.pages = make_pages(
+        os.path.join(os.environ.get("COVID19_WORK_DIR", "./work"), "fixture")
+    )
+
+    if args.mode == "serve":
+        print(f"Serving on {os.environ['COVID19_BASE_URL']} with \"{args.profile}\" profile")
+        try:
+            fixture_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    import util
+    # タイムアウトの障害で長く待たされないよう、読み込みのタイムアウトを短くする
+    util.http_timeout = (util.http_timeout[0], args.read_timeout)
+    threading.Thread(target=fixture_server.serve_forever, daemon=True).start()
+    results = {
+        "date": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "patients": fixture_patients,
+        "results": run_fetch_benchmark(fixture_server, args.profiles, args.runs)
+    }
+    fixture_server.shutdown()
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(dumps(results, ensure_ascii=False, indent=4))
+    util.print_log("fixture", f"Results are written to {args.output}")
@@ -1,19 +1,27 @@
 # -*- coding: utf-8 -*-
 import re
 import jaconv
-import inspect
 import requests
 import os
+import sys
+import pickle
+import shutil
 
+from array import array
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, timedelta
-from jsonschema import validate, exceptions
-from openpyxl.worksheet.worksheet import Worksheet
-from json import dumps
+from jsonschema import exceptions
+from json import dumps, loads
+from bs4 import BeautifulSoup
 
-from typing import Dict, List
+from typing import Union, Dict, List, Optional, Tuple
 
-from util import (SUMMARY_INIT, return_date, get_html_soup, get_file, get_weekday, loads_json, dumps_json, return_ymd,
-                  jst, print_log, requests_now_data_json, PatientsColumns, InspectionsColumns, MainSummaryColumns)
+from util import (SUMMARY_INIT, return_date, get_html, parse_html, get_files, load_sheet_table, use_now_data_dir,
+                  save_now_data_jsons, get_weekday, loads_json, dumps_json, return_ymd, jst, print_log,
+                  requests_now_data_json, prefetch_now_data_jsons, fetched_digests, file_digest, json_digest,
+                  load_manifest, save_manifest, save_cached_json, load_cached_json, set_action_output,
+                  get_schema_validator, measure, run_report, base_url, SheetTable, RollingWindow, PatientsColumns,
+                  InspectionsColumns, MainSummaryColumns)
 
 # 年代表記の指定
 age_display_normal = "代"
@@ -21,47 +29,240 @@ age_display_min = "歳未満"
 age_display_max = "歳以上"
 age_display_unpublished = "非公表"
 
-# スクリプト実行時に必要なファイル軍のダウンロード
-# main実行時でなくとも実行するようにする
-print_log("main", "Downloading open data...")
-# データファイルの取得
-# DataManagerだけでなく、DataValidatorでも使用するのでクラスの外に出している
-patients_files = []
-patients_file_count = 0
-while True:
-    try:
-        workbook = get_file("/kk03/corona_hasseijyokyo.html", True, patients_file_count)
-        patients_files.append(workbook.worksheets[0])
-        patients_file_count += 1
-    except AssertionError:
-        break
+# データファイルが掲載されているページ
+patients_page = "/kk03/corona_hasseijyokyo.html"
+inspections_page = "/kf16/coronavirus_data.html"
+
+# 各ステージの中間ファイル(ダウンロードしたファイル、読み込んだテーブル、デプロイされているjsonなど)の保存先
+# fetchステージで保存したものを使えば、build以降のステージはネットワークに接続せずに何度でも実行し直せる
+work_dir = os.environ.get("COVID19_WORK_DIR", "./work")
 
-inspections = get_file("/kf16/coronavirus_data.html", True, 1).worksheets[0]
-summary = get_file("/kf16/coronavirus_data.html", True).worksheets[0]
-print_log("main", "Complete download of open data.")
+# patients.jsonを差分で作成するかどうかと、その際に前回のデータを作り直す(見直す)最新の件数の指定
+# 患者番号は単調に増えていき、公開済みのデータはほとんど変わらないので、前回のpatients.jsonを再利用して新しい患者だけを追加する
+patients_incremental = True
+patients_lookback_rows = 200
+# 差分で作成したjsonは、新しく追加したデータだけをバリデーションチェックするかどうかの指定
+validate_appended_only = True
+# jsonを並列に生成、出力する際のスレッド数
+build_workers = 4
 
+# 解決された警告をopen_data_warnings_archive.jsonに移すまでの日数
+warnings_archive_days = 30
 
 # Excelファイルのデータの探索を始める最初の行や列の指定
-patients_first_rows = [1] * len(patients_files)
+patients_first_row = 1
 inspections_first_row = 2
 main_summary_first_row = 2
 
-# 医療機関からの発生届が取り下げられたなどの理由により、除外された患者番号を残しておくリスト
-exclude_patients = []
+# 患者データの最終更新日時("M/D H時現在"など)を探す、シートの左上の範囲(行数と列数)
+patients_header_rows = 5
+patients_header_columns = 100
+# 最終更新日時と、24時(datetime.strptimeで読み取れない)の表記のパターン
+last_update_pattern = re.compile(r"\d+時現在")
+midnight_pattern = re.compile(r"^(.*\S)\s+24時現在$")
+
+
+class PatientsTable:
+    # 患者データを列ごとのリストとして保持するクラス
+    # patients_sheetsは一度だけ走査してこのテーブルに変換し、患者データを用いるjsonは全てここから集計する
+    def __init__(self):
+        self.numbers = []
+        # 発表日(タイムゾーン付きのdatetime)
+        self.release_dates = []
+        # 年代を数値にしたもの。10歳未満は0、90歳以上は90、非公表は100として扱う
+        self.ages = []
+        # patients.jsonに出力する年代の表記
+        self.age_labels = []
+        self.sexes = []
+        self.residences = []
+        self.notes = []
+        # 以下はDataValidatorでの検証のみに用いる
+        # シートに記載されたままの年代
+        self.raw_ages = []
+        self.jurisdictions = []
+        self.onset_dates = []
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def append(self, num: int, release_date: datetime, age, sex, residence, note, jurisdiction, onset_date) -> None:
+        self.numbers.append(num)
+        self.release_dates.append(release_date)
+        self.raw_ages.append(age)
+        self.jurisdictions.append(jurisdiction)
+        self.onset_dates.append(onset_date)
+        # なぜか文字列型の数字が含まれるので、修正
+        try:
+            age = int(age)
+        except Exception:
+            pass
+        if isinstance(age, int):
+            self.ages.append(age)
+            self.age_labels.append(str(age) + age_display_normal)
+        else:
+            if age == age_display_unpublished:
+                self.ages.append(100)
+            elif age_display_max in age:
+                self.ages.append(90)
+            else:
+                self.ages.append(0)
+            # 「10代未満」の表記を「10歳未満」で統一
+            if age[-2:] == age_display_min[1:]:
+                self.age_labels.append("10" + age_display_min)
+            else:
+                # 「90歳以上」と「非公表」はそのまま
+                self.age_labels.append(age)
+        # 改行が含まれることがあるので置き換える
+        self.sexes.append(str(sex).replace("\n", ""))
+        self.residences.append(str(residence).replace("\n", ""))
+        # No.の表記にブレが激しいので、ここで"No."に修正(統一)。また、"・"を"、"に置き換える
+        if note:
+            note = re.sub('NO.|N0.|NO,|N0,|No,', 'No.', str(note)).replace("・", "、").replace("\n", " ")
+        else:
+            note = None
+        self.notes.append(note)
+
+
+def age_label(age: int) -> str:
+    # PatientsTableの年代の数値を、age.jsonやage_summary.jsonで用いる表記に変換する
+    if age == 100:
+        return age_display_unpublished
+    elif age == 0:
+        return "10" + age_display_min
+    elif age == 90:
+        return "90" + age_display_max
+    return str(age) + age_display_normal
+
+
+def header_layout(block: List[tuple]) -> str:
+    # 最終更新日時以外の文字列の位置と内容から、シートのレイアウトを識別するキーを作る
+    return json_digest([
+        [row, column, value] for row, values in enumerate(block, 1) for column, value in enumerate(values, 1)
+        if isinstance(value, str) and not last_update_pattern.search(jaconv.z2h(value, digit=True, ascii=True))
+    ])
+
+
+def locate_last_update(block: List[tuple]) -> Dict:
+    # シートの左上の範囲を一度だけ走査し、最終更新日時が書かれたセルの位置を返す
+    # 1行目は10列目から、それ以降の行は16列目から探す
+    # 式(TODAY()-1)が含まれている場合は日付がdatetime型で取得され、時間が右側の別の枠にあるので、その列も返す
+    for row, values in enumerate(block, 1):
+        for column in range(10 if row == 1 else 16, len(values) + 1):
+            value = values[column - 1]
+            if isinstance(value, datetime):
+                for hour_column in range(column + 1, len(values) + 1):
+                    if values[hour_column - 1]:
+                        return {"row": row, "column": column, "hour_column": hour_column}
+            elif value and last_update_pattern.search(jaconv.z2h(str(value), digit=True, ascii=True)):
+                return {"row": row, "column": column, "hour_column": None}
+    raise Exception("Can't find last update of patients!")
+
+
+def read_last_update(block: List[tuple], location: Dict) -> str:
+    # locationのセルから最終更新日時の文字列を読み取る。そのセルに最終更新日時がなければ空文字列を返す
+    try:
+        values = block[location["row"] - 1]
+        value = values[location["column"] - 1]
+        hour_value = values[location["hour_column"] - 1] if location["hour_column"] else None
+    except (IndexError, KeyError, TypeError):
+        return ""
+    if isinstance(value, datetime):
+        if not hour_value:
+            return ""
+        return return_ymd(value) + " " + jaconv.z2h(str(hour_value), digit=True, ascii=True)
+    if not value or location["hour_column"]:
+        return ""
+    # 数字に全角半角が混じっていることがあるので、半角に統一
+    data_time_str = jaconv.z2h(str(value), digit=True, ascii=True)
+    return data_time_str if last_update_pattern.search(data_time_str) else ""
+
+
+class Product:
+    # DataManagerで生成するjsonの定義
+    # nameは"xxx.json"のxxxで、対応する"make_xxx"関数と"xxx_json"関数を持つ
+    # dependsには、生成時に参照する他のjsonのnameを指定する
+    def __init__(self, name: str, depends: Tuple[str, ...] = ()):
+        self.name = name
+        self.json_name = name + ".json"
+        self.depends = depends
+
+
+class Rule:
+    # DataValidatorで行う検証の定義
+    # nameは"check_xxx"関数のxxxで、dependsには先に実行しておく必要のある検証のnameを指定する
+    def __init__(self, name: str, depends: Tuple[str, ...] = ()):
+        self.name = name
+        self.depends = depends
+
+
+# 生成するjsonと、行う検証の一覧(登録順)
+# 以降生成するjsonや検証を増やす場合は、"make_xxx"や"check_xxx"関数に下のデコレータを付ければ登録される
+products: Dict[str, Product] = {}
+rules: Dict[str, Rule] = {}
+
+
+def register_product(*depends: str):
+    # "make_xxx"関数に付けて、xxx.jsonをproductsに登録するデコレータ
+    def register(func):
+        name = func.__name__[len("make_"):]
+        products[name] = Product(name, depends)
+        return func
+    return register
+
+
+def register_rule(*depends: str):
+    # "check_xxx"関数に付けて、その検証をrulesに登録するデコレータ
+    def register(func):
+        name = func.__name__[len("check_"):]
+        rules[name] = Rule(name, depends)
+        return func
+    return register
+
+
+def resolve_order(registry: Dict, names: List[str]) -> List[str]:
+    # 指定されたものとその依存先を、依存先が先に来る順に並べる
+    order = []
+    visiting = set()
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        if name not in registry:
+            raise Exception(f"{name} is not registered!")
+        if name in visiting:
+            raise Exception(f"Circular dependency found in {name}!")
+        visiting.add(name)
+        for depend in registry[name].depends:
+            visit(depend)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
 
 
 class DataManager:
-    def __init__(self, patients_sheets: List[Worksheet], inspections_sheet: Worksheet, summary_sheet: Worksheet):
+    def __init__(self, patients_sheets: List[SheetTable], inspections_sheet: SheetTable, summary_sheet: SheetTable,
+                 top_page: BeautifulSoup):
         # データファイルの設定
         self.patients_sheets = patients_sheets
         self.inspections_sheet = inspections_sheet
         self.summary_sheet = summary_sheet
+        # 警戒レベルの判定に使うトップページ
+        self.top_page = top_page
         # データ量(行数)を調べ始める最初の行の指定
-        self.patients_counts = patients_first_rows.copy()
+        # 患者データは空白行を飛ばした、実際にデータが始まる行をファイルごとに持つ
+        self.patients_first_rows = [patients_first_row] * len(patients_sheets)
+        self.patients_counts = self.patients_first_rows.copy()
         self.inspections_count = inspections_first_row
         self.data_count = main_summary_first_row
         # 検査数や入院者数などを格納するリスト
         self.summary_values = []
+        # 医療機関からの発生届が取り下げられたなどの理由により、除外された患者番号の集合
+        # 行ごとに含まれるかを調べるので、リストではなく集合で持ち、ソートしたリストはpatients.jsonの出力時のみ作る
+        self.exclude_patients = set()
+        # 前回のjsonから再利用した(チェック済みの)"data"の件数。jsonのファイル名をキーとする
+        self.reused_data_counts = {}
         # 以下、内部変数
         self._patients_json = {}
         self._patients_summary_json = {}
@@ -74,9 +275,21 @@ class DataManager:
         self._positive_or_negative_json = {}
         self._warning_and_phase_json = {}
         # 初期化(最大行数の取得)
-        self.get_patients()
-        self.get_inspections()
-        self.get_data_count()
+        with measure("scan_sheet", "patients"):
+            self.get_patients()
+            # 患者データは一度だけ読み込み、テーブルにしておく
+            self.patients_table = self.get_patients_table()
+        with measure("scan_sheet", "inspections"):
+            self.get_inspections()
+            # 日付から行番号を引くための索引
+            self.inspections_date_rows = self.inspections_sheet.date_index(
+                InspectionsColumns.年月日, inspections_first_row, self.inspections_count
+            )
+        with measure("scan_sheet", "summary"):
+            self.get_data_count()
+        # 患者データを用いるjsonは並列に生成されるので、最終更新日時はここで一度だけ取得しておく
+        with measure("scan_sheet", "patients_header"):
+            self.patients_last_update = self.find_patients_last_update()
 
     def json_template_of_patients(self) -> Dict:
         # patients_sheetを用いるデータ向けのテンプレート
@@ -99,47 +312,95 @@ class DataManager:
             "last_update": self.get_inspections_last_update()
         }
 
-    def dump_and_check_all_data(self) -> bool:
-        # xxx_json の名を持つ関数のリストを生成し(_で始まる内部変数は除外する)
-        # その後jsonschemaを使ってバリデーションチェックをし、現在のjsonと比較してフラグ(changed_flag)を操作する
-        # ちなみに、以降生成するjsonを増やす場合は"_json"で終わる関数と"_"で始まる、関数に対応する内部変数を用意すれば自動で認識される
-        json_list = [
-            member[0] for member in inspect.getmembers(self) if member[0][-4:] == "json" and member[0][0] != "_"
-        ]
+    @classmethod
+    def json_names(cls) -> List[str]:
+        # 生成するjsonのファイル名のリストを返す
+        return [product.json_name for product in products.values()]
+
+    def dump_and_check_all_data(self, names: Optional[List[str]] = None) -> bool:
+        # 登録されたjsonを依存先から順に生成し、jsonschemaを使ってバリデーションチェックをし、
+        # 現在のjsonと比較してフラグ(changed_flag)を操作する
+        # namesを指定した場合は、そのjsonと依存先だけを生成し、指定したjsonだけを出力する
+        targets = list(products) if names is None else names
 
         # 変更検知用フラグ
         changed_flag = False
+        # 現在デプロイされているjsonのハッシュ値と、今回作成したjsonのハッシュ値
+        now_digests = requests_now_data_json("digests.json")
+        # 一部のjsonだけを出力する場合は、出力しないjsonのハッシュ値は現在のものを引き継ぐ
+        digests = {} if names is None else dict(now_digests)
+
+        # 各jsonは別のスレッドで生成し、依存先のjsonの生成が終わるのだけを待つ
+        # 依存先は必ず先に投入されるので、待っている間に依存先が実行されずに詰まることはない
+        order = resolve_order(products, targets)
+        futures = {}
+        with ThreadPoolExecutor(max_workers=build_workers) as executor:
+            for name in order:
+                futures[name] = executor.submit(
+                    self.build_product, name, [futures[depend] for depend in products[name].depends],
+                    name in targets, now_digests
+                )
+            for name in order:
+                result = futures[name].result()
+                if result is None:
+                    continue
+                digests[products[name].json_name], changed = result
+                if changed:
+                    changed_flag = True
+
+        # 次回の変更検知のために、各jsonのハッシュ値をまとめたファイルも出力する
+        print_log("data_manager", "Dumps digests.json...")
+        dumps_json("digests.json", digests)
 
-        for json in json_list:
-            # 関数は"_json"で終わっているので、それを拡張子に直す必要がある
-            json_name = json[:-5] + ".json"
-            print_log("data_manager", f"Make {json_name}...")
-            # evalで文字列から関数を呼び出している
-            made_json = eval("self." + json + "()")
-
-            # 現在デプロイされているjsonを取得し、現在のjsonと比較する
-            # 比較結果が「等しくない」のであれば、そのファイルのバリデーションチェックをして出力、
-            # 「等しい」のであればそのまま出力する
-            now_json = requests_now_data_json(json_name)
-            if now_json != made_json:
-                changed_flag = True
-
-                # schemaを読み込み、作成したjsonをチェックする。
-                print_log("data_manager", f"Validate {json_name}...")
-                schema = loads_json(json_name)
+        return changed_flag
+
+    def build_product(
+            self, name: str, depends: List[Future], dump: bool, now_digests: Dict
+    ) -> Optional[Tuple[str, bool]]:
+        # jsonを1つ生成し、dumpがTrueならバリデーションチェックをして出力する
+        # 出力した場合は、jsonのハッシュ値と、現在デプロイされているjsonから変更があったかを返す
+        for depend in depends:
+            depend.result()
+        json_name = products[name].json_name
+        print_log("data_manager", f"Make {json_name}...")
+        with measure("make", json_name) as record:
+            made_json = getattr(self, name + "_json")()
+        print_log("data_manager", f"Made {json_name} in {record['seconds']:.3f}s.")
+        if not dump:
+            # 依存先として生成しただけのjsonは出力しない
+            return None
+
+        # 現在デプロイされているjsonと、現在のjsonをハッシュ値で比較する
+        # digests.jsonにハッシュ値がない場合(初回など)は、デプロイされているjsonそのものを取得して比較する
+        # 比較結果が「等しくない」のであれば、そのファイルのバリデーションチェックをして出力、
+        # 「等しい」のであればそのまま出力する
+        digest = json_digest(made_json)
+        if json_name in now_digests:
+            changed = now_digests[json_name] != digest
+        else:
+            changed = requests_now_data_json(json_name) != made_json
+        if changed:
+            # schemaから作成したバリデータ(キャッシュされている)を用いて、作成したjsonをチェックする。
+            print_log("data_manager", f"Validate {json_name}...")
+            validator = get_schema_validator(json_name)
+            instance = made_json
+            # 前回のjsonから再利用したデータはチェック済みなので、新しく追加したデータだけをチェックする
+            reused_count = self.reused_data_counts.get(json_name, 0)
+            if validate_appended_only and reused_count:
+                instance = dict(made_json, data=made_json["data"][reused_count:])
+            with measure("validate", json_name):
                 try:
-                    validate(made_json, schema)
+                    validator.validate(instance)
                 except exceptions.ValidationError:
                     raise Exception(f"Check failed {json_name}!")
-                print_log("data_manager", f"{json_name} is OK!")
-            else:
-                print_log("data_manager", f"{json_name} has not changed.")
+            print_log("data_manager", f"{json_name} is OK!")
+        else:
+            print_log("data_manager", f"{json_name} has not changed.")
 
-            # jsonを出力
-            print_log("data_manager", f"Dumps {json_name}...")
-            dumps_json(json_name, made_json)
-
-        return changed_flag
+        # jsonを出力
+        print_log("data_manager", f"Dumps {json_name}...")
+        dumps_json(json_name, made_json)
+        return digest, changed
 
     # 以下、内部変数を読み取って空ならデータを作成し返す仕組み
     # 直接内部変数を用いるのは、"make_xxx"などでデータを編集するときのみ
@@ -193,62 +454,69 @@ class DataManager:
             self.make_warning_and_phase()
         return self._warning_and_phase_json
 
+    @register_product()
     def make_patients(self) -> None:
         # patients.jsonのデータを作成する
         self._patients_json = self.json_template_of_patients()
 
-        # patients_sheetsを一つずつ読んでいく
-        for i, patients_sheet in enumerate(self.patients_sheets):
-            # patients_sheetからデータを読み取っていく
-            for j in range(patients_first_rows[i], self.patients_counts[i]):
-                data = {}
-                num = patients_sheet.cell(row=j, column=PatientsColumns.番号).value
-                # 除外する患者はパスする
-                if num in exclude_patients:
-                    continue
-                release_date = return_date(patients_sheet.cell(row=j, column=PatientsColumns.発表日).value)
-                data["No"] = num
-                data["リリース日"] = release_date.isoformat()
-                data["曜日"] = get_weekday(release_date.weekday())
-                # 改行が含まれることがあるので置き換える
-                data["居住地"] = str(patients_sheet.cell(row=j, column=PatientsColumns.居住地).value).replace("\n", "")
-                # 年代を一旦取得。「10歳未満」や「90歳以上」、「非公表」と表記されていれば、str型と認識されるので、それを用いて判別する
-                age = patients_sheet.cell(row=j, column=PatientsColumns.年代).value
-                # なぜか文字列型の数字が含まれるので、修正
-                try:
-                    age = int(age)
-                except Exception:
-                    pass
-                if isinstance(age, int):
-                    data["年代"] = str(age) + age_display_normal
-                else:
-                    # 「10代未満」の表記を「10歳未満」で統一
-                    if age[-2:] == age_display_min[1:]:
-                        data["年代"] = "10" + age_display_min
-                    else:
-                        # 「90歳以上」と「非公表」はそのまま
-                        data["年代"] = age
-                data["性別"] = str(patients_sheet.cell(row=j, column=PatientsColumns.性別).value).replace("\n", "")
-                data["退院"] = None
-                # No.の表記にブレが激しいので、ここで"No."に修正(統一)。また、"・"を"、"に置き換える
-                note = patients_sheet.cell(
-                    # 旧ファイル形式(最後のファイル)だけ備考欄の位置がずれているので"2"増やす
-                    row=j, column=PatientsColumns.備考欄 - (0 if i != len(self.patients_sheets) - 1 else 2)
-                ).value
-                data["備考"] = None
-                if note:
-                    data["備考"] = re.sub(
-                        'NO.|N0.|NO,|N0,|No,', 'No.', str(note)
-                    ).replace("・", "、").replace("\n", " ")
-                data["date"] = release_date.strftime("%Y-%m-%d")
-
-                self._patients_json["data"].append(data)
-
-        # No順にソート
+        table = self.patients_table
+        rows = range(len(table))
+        # 前回のpatients.jsonが使える場合は、それより新しい患者のデータだけを作成して追加する
+        stable_data = self.get_stable_patients_data()
+        if stable_data:
+            stable_number = stable_data[-1]["No"]
+            self._patients_json["data"] = stable_data
+            self.reused_data_counts["patients.json"] = len(stable_data)
+            rows = [i for i in rows if table.numbers[i] > stable_number]
+            print_log("data_manager", f"Reuse {len(stable_data)} patients, make {len(rows)} patients.")
+        for i in rows:
+            release_date = table.release_dates[i]
+            self._patients_json["data"].append({
+                "No": table.numbers[i],
+                "リリース日": release_date.isoformat(),
+                "曜日": get_weekday(release_date.weekday()),
+                "居住地": table.residences[i],
+                "年代": table.age_labels[i],
+                "性別": table.sexes[i],
+                "退院": None,
+                "備考": table.notes[i],
+                "date": release_date.strftime("%Y-%m-%d")
+            })
+
+        # No順にソート(差分で作成した場合はほぼ整列済みなので、ほとんど時間はかからない)
         self._patients_json["data"].sort(key=lambda x: x["No"])
 
         # exclude_patientsを入れる
-        self._patients_json["exclude_patients"] = sorted(exclude_patients)
+        self._patients_json["exclude_patients"] = sorted(self.exclude_patients)
+
+    def get_stable_patients_data(self) -> List[Dict]:
+        # 前回出力したpatients.jsonのうち、見直しの対象となる最新のpatients_lookback_rows件より前のデータを返す
+        # 前回のデータが使えない場合は空のリストを返し、全て作り直させる
+        if not patients_incremental:
+            return []
+        # ローカルに前回のファイルがあればそれを使う
+        # なければキャッシュに保存しておいたものを、デプロイされているものとハッシュ値が一致する場合のみ使い、
+        # それもなければ現在デプロイされているものを取得して使う
+        if os.path.exists("./data/patients.json"):
+            prev_json = loads_json("patients.json", "data")
+        else:
+            prev_json = load_cached_json("patients.json")
+            if json_digest(prev_json) != requests_now_data_json("digests.json").get("patients.json"):
+                prev_json = requests_now_data_json("patients.json")
+        prev_data = prev_json.get("data", [])
+        prev_data = prev_data[:max(len(prev_data) - patients_lookback_rows, 0)]
+        if not prev_data:
+            return []
+        # 除外が解除された患者がいる場合は、途中にデータを挿入する必要があるので作り直す
+        if not set(prev_json.get("exclude_patients", [])) <= self.exclude_patients:
+            return []
+        stable_number = prev_data[-1]["No"]
+        # 新たに除外された患者は取り除く
+        stable_data = [data for data in prev_data if data["No"] not in self.exclude_patients]
+        # 前回のデータにない患者が途中に追加されている場合も作り直す
+        if sum(1 for num in self.patients_table.numbers if num <= stable_number) != len(stable_data):
+            return []
+        return stable_data
 
     # 以前、データが正常に生成されないことがあったので、inspections_sheetから生成するよう変更済み
     # 念のため、負の遺産として残してある
@@ -287,6 +555,7 @@ class DataManager:
     #             make_data((prev_date + timedelta(days=i)).replace(tzinfo=jst).isoformat(), 0)
     #         )
 
+    @register_product("inspections")
     def make_patients_summary(self) -> None:
         # patients_summary.jsonの作成
         self._patients_summary_json = self.json_template_of_inspections()
@@ -299,6 +568,7 @@ class DataManager:
             }
             self._patients_summary_json["data"].append(data)
 
+    @register_product()
     def make_age(self) -> None:
         # age.jsonのデータを作成する
         self._age_json = self.json_template_of_patients_data_dict()
@@ -316,39 +586,11 @@ class DataManager:
             else:
                 self._age_json["data"][age_display_unpublished] = 0
 
-        for i, patients_sheet in enumerate(self.patients_sheets):
-            for j in range(patients_first_rows[i], self.patients_counts[i]):
-                # 除外する患者はcontinueで飛ばす
-                if patients_sheet.cell(row=j, column=PatientsColumns.番号).value in exclude_patients:
-                    continue
-                age = patients_sheet.cell(row=j, column=PatientsColumns.年代).value
-                try:
-                    age = int(age)
-                except Exception:
-                    pass
-                suffix = age_display_normal
-                if isinstance(age, str):
-                    if age == age_display_unpublished:
-                        self._age_json["data"][age_display_unpublished] += 1
-                        continue
-                    elif age_display_max in age:
-                        age = 90
-                        suffix = age_display_max
-                    else:
-                        age = 10
-                        suffix = age_display_min
-                elif age == 90:
-                    suffix = age_display_max
-                self._age_json["data"][str(age) + suffix] += 1
+        for age in self.patients_table.ages:
+            self._age_json["data"][age_label(age)] += 1
 
+    @register_product()
     def make_age_summary(self) -> None:
-        # 内部データテンプレート
-        def make_data():
-            data = {}
-            for i in range(11):
-                data[str(i * 10)] = 0
-            return data
-
         # age_summary.jsonを作成する
         self._age_summary_json = {
             "data": {},
@@ -356,143 +598,52 @@ class DataManager:
             "last_update": self.get_patients_last_update()
         }
 
-        # 初期化
-        for i in range(11):
-            if i != 10:
-                suffix = age_display_normal
-                if i == 0:
-                    i = 1
-                    suffix = age_display_min
-                elif i == 9:
-                    suffix = age_display_max
-                self._age_summary_json["data"][str(i * 10) + suffix] = []
-            else:
-                self._age_summary_json["data"][age_display_unpublished] = []
-
-        # 以前のデータを保管する
-        # これは、前の患者データと日付が同じであるか否かを比較するための変数
-        patients_age_data = []
-        for i, patients_sheet in enumerate(self.patients_sheets):
-            for j in range(patients_first_rows[i], self.patients_counts[i]):
-                # 10歳未満と、年代非公表者を判別するため、一旦ageに代入し、
-                # 年代非公表者は例外として100歳代、10歳未満は便宜上0歳代として扱わせる
-
-                # 除外する患者はcontinueで飛ばす
-                if patients_sheet.cell(row=j, column=PatientsColumns.番号).value in exclude_patients:
-                    continue
-                age = patients_sheet.cell(row=j, column=PatientsColumns.年代).value
-                try:
-                    age = int(age)
-                except Exception:
-                    pass
-                if isinstance(age, str):
-                    if age == age_display_unpublished:
-                        age = 100
-                    elif age_display_max in age:
-                        age = 90
-                    else:
-                        age = 0
-                age_data = {
-                    "年代": age,
-                    "date": return_date(patients_sheet.cell(row=j, column=PatientsColumns.発表日).value).isoformat()
-                }
-                patients_age_data.append(age_data)
-        patients_age_data.sort(key=lambda x: x['date'])
-
-        prev_data = {}
-        for patient in patients_age_data:
-            date = patient["date"]
-            if prev_data:
-                prev_date = datetime.strptime(prev_data["date"], "%Y-%m-%dT%H:%M:%S+09:00")
-                # 前のデータと日付が離れている場合、その分0のデータを埋める必要があるので、そのために差を取得する
-                patients_zero_days = (datetime.strptime(date, "%Y-%m-%dT%H:%M:%S+09:00") - prev_date).days
-                # 前のデータと日付が同じ場合、前のデータに人数を加算していく
-                if prev_data["date"] == date:
-                    # 接尾語は扱いづらいので、数字だけに置き換えた辞書で代用している
-                    # popで10歳未満や90代以上などの扱いづらいデータを全部0～90に置き換えたものを取り出し、
-                    # その後取り出したものに加算し、insertで置き換え直して代入する
-                    data = self.pop_age_value()
-                    data[str(patient["年代"])] += 1
-                    self.insert_age_value(data)
-                    continue
-                else:
-                    # 前のデータとの日付の差が2日以上の場合は空いている日にち分、0を埋める
-                    if patients_zero_days >= 2:
-                        for i in range(1, patients_zero_days):
-                            self.insert_age_value(make_data())
-                            self._age_summary_json["labels"].append(
-                                return_ymd((prev_date + timedelta(days=i)).replace(tzinfo=jst))
-                            )
-
-            data = make_data()
-            data[str(patient["年代"])] += 1
-            # 作成したデータをリストにinsert
-            self.insert_age_value(data)
-            # 日時取得のため、前のデータを登録
-            prev_data = patient
-            self._age_summary_json["labels"].append(
-                return_ymd(datetime.strptime(prev_data["date"], "%Y-%m-%dT%H:%M:%S+09:00"))
-            )
-
-        prev_date = datetime.strptime(prev_data["date"], "%Y-%m-%dT%H:%M:%S+09:00")
+        # 年代の区分は、10歳未満(0)から非公表(100)までの11区分
+        age_buckets = 11
+        table = self.patients_table
+        # 最初の患者の発表日からの経過日数を、日付の整数表現(toordinal)の差で求める
+        days = [release_date.date().toordinal() for release_date in table.release_dates]
+        first_day = min(days)
+        last_day = max(days)
         # 最終更新のデータから日付が開いている場合、0で埋める
-        patients_zero_days = (datetime.now() - prev_date).days - 1
-        for i in range(1, patients_zero_days):
-            self.insert_age_value(make_data())
-            self._age_summary_json["labels"].append(
-                return_ymd((prev_date + timedelta(days=i)).replace(tzinfo=jst))
-            )
-
-    def insert_age_value(self, day_age: Dict) -> None:
-        for i in range(11):
-            if i != 10:
-                j = i
-                suffix = age_display_normal
-                if i == 0:
-                    i = 1
-                    suffix = age_display_min
-                elif i == 9:
-                    suffix = age_display_max
-                self._age_summary_json["data"][str(i * 10) + suffix].append(day_age[str(j * 10)])
-            else:
-                self._age_summary_json["data"][age_display_unpublished].append(day_age[str(i * 10)])
-
-    def pop_age_value(self) -> Dict:
-        result = {}
-        for i in range(11):
-            j = i
-            suffix = age_display_normal
-            if i == 0:
-                i = 1
-                suffix = age_display_min
-            elif i == 9:
-                suffix = age_display_max
-            elif i == 10:
-                result[str(j * 10)] = self._age_summary_json["data"][age_display_unpublished].pop()
-                continue
-            result[str(j * 10)] = self._age_summary_json["data"][str(i * 10) + suffix].pop()
-        return result
+        last_date = datetime.fromordinal(last_day)
+        patients_zero_days = (datetime.now() - last_date).days - 1
+        days_count = last_day - first_day + 1 + max(patients_zero_days - 1, 0)
+
+        # 日付 × 年代区分の人数を、一次元の配列を二次元の表とみなして一度の走査で数え上げる
+        # 患者のいない日は初期値の0のままになるので、別途0を埋める必要はない
+        counts = array("l", [0]) * (days_count * age_buckets)
+        for day, age in zip(days, table.ages):
+            counts[(day - first_day) * age_buckets + age // 10] += 1
+
+        for i in range(age_buckets):
+            self._age_summary_json["data"][age_label(i * 10)] = counts[i::age_buckets].tolist()
+        self._age_summary_json["labels"] = [
+            return_ymd(datetime.fromordinal(first_day + i)) for i in range(days_count)
+        ]
 
+    @register_product()
     def make_inspections(self) -> None:
         # inspections.jsonの作成
         self._inspections_json = self.json_template_of_inspections()
 
         for i in range(inspections_first_row, self.inspections_count):
-            date = self.inspections_sheet.cell(row=i, column=InspectionsColumns.年月日).value
+            date = self.inspections_sheet.value(i, InspectionsColumns.年月日)
             data = {
                 "判明日": date.strftime("%Y-%m-%d"),
                 # 0すら入ってない場合はNoneが返ってくるので、0に置き換える
-                "地方衛生研究所等": self.inspections_sheet.cell(
-                    row=i, column=InspectionsColumns.地方衛生研究所PCR
-                ).value or 0,
+                "地方衛生研究所等": self.inspections_sheet.value(
+                    i, InspectionsColumns.地方衛生研究所PCR
+                ) or 0,
                 "民間検査機関等": {
-                    "PCR検査": self.inspections_sheet.cell(row=i, column=InspectionsColumns.民間検査機関PCR).value or 0,
-                    "抗原検査": self.inspections_sheet.cell(row=i, column=InspectionsColumns.民間検査機関抗原).value or 0
+                    "PCR検査": self.inspections_sheet.value(i, InspectionsColumns.民間検査機関PCR) or 0,
+                    "抗原検査": self.inspections_sheet.value(i, InspectionsColumns.民間検査機関抗原) or 0
                 },
-                "陽性確認": self.inspections_sheet.cell(row=i, column=InspectionsColumns.陽性件数).value or 0
+                "陽性確認": self.inspections_sheet.value(i, InspectionsColumns.陽性件数) or 0
             }
             self._inspections_json["data"].append(data)
 
+    @register_product("inspections")
     def make_inspections_summary(self) -> None:
         # inspections_summary.jsonの作成
         self._inspections_summary_json = {
@@ -510,6 +661,7 @@ class DataManager:
             self._inspections_summary_json["data"]["民間検査機関等"].append(sum(inspections_data["民間検査機関等"].values()))
             self._inspections_summary_json["labels"].append(return_ymd(date))
 
+    @register_product("inspections_summary")
     def make_main_summary(self) -> None:
         # main_summary.jsonの作成
         # これに関してはテンプレートが大きいのでSUMMARY_INITとして別ファイルに退避している
@@ -526,6 +678,7 @@ class DataManager:
         self.summary_values = self.get_summary_values()
         self.set_summary_values(self._main_summary_json)
 
+    @register_product()
     def make_current_patients(self) -> None:
         # 内部データテンプレート
         def make_data(date, value):
@@ -535,23 +688,21 @@ class DataManager:
         self._current_patients_json = self.json_template_of_inspections()
 
         # まずはinspections_sheetからデータを取得
-        for i in range(inspections_first_row, self.inspections_count):
-            date = self.inspections_sheet.cell(row=i, column=InspectionsColumns.年月日).value
+        # summary_sheetの最初のデータの日付までを、索引から求めた行番号まで読む
+        summary_date = self.summary_sheet.value(main_summary_first_row, MainSummaryColumns.発表年月日)
+        last_row = self.inspections_date_rows.get(summary_date.date(), self.inspections_count - 1)
+        for i in range(inspections_first_row, last_row + 1):
+            date = self.inspections_sheet.value(i, InspectionsColumns.年月日)
             # summary_sheetの最初のデータの日付を超えたらbreak
-            summary_date = self.summary_sheet.cell(row=main_summary_first_row, column=MainSummaryColumns.発表年月日).value
             if date > summary_date:
                 break
             if date == summary_date:
                 self._current_patients_json["data"].append(
                     make_data(
                         date.replace(tzinfo=jst).isoformat(),
-                        self.inspections_sheet.cell(row=i, column=InspectionsColumns.陽性件数).value - (
-                                self.summary_sheet.cell(
-                                    row=main_summary_first_row, column=MainSummaryColumns.死亡
-                                ).value +
-                                self.summary_sheet.cell(
-                                    row=main_summary_first_row, column=MainSummaryColumns.退院
-                                ).value
+                        self.inspections_sheet.value(i, InspectionsColumns.陽性件数) - (
+                                self.summary_sheet.value(main_summary_first_row, MainSummaryColumns.死亡) +
+                                self.summary_sheet.value(main_summary_first_row, MainSummaryColumns.退院)
                         )
                     )
                 )
@@ -559,59 +710,60 @@ class DataManager:
                 self._current_patients_json["data"].append(
                     make_data(
                         date.replace(tzinfo=jst).isoformat(),
-                        self.inspections_sheet.cell(row=i, column=InspectionsColumns.陽性件数).value
+                        self.inspections_sheet.value(i, InspectionsColumns.陽性件数)
                     )
                 )
 
         # 次にsummary_sheetからデータを取得
         for i in range(main_summary_first_row + 1, self.data_count):
-            date = self.summary_sheet.cell(row=i, column=MainSummaryColumns.発表年月日).value
+            date = self.summary_sheet.value(i, MainSummaryColumns.発表年月日)
             # 取られるデータが累計値のため、以前の値を引く必要がある
-            discharged = (self.summary_sheet.cell(row=i, column=MainSummaryColumns.退院).value -
-                          self.summary_sheet.cell(row=i - 1, column=MainSummaryColumns.退院).value)
-            deaths = (self.summary_sheet.cell(row=i, column=MainSummaryColumns.死亡).value -
-                      self.summary_sheet.cell(row=i - 1, column=MainSummaryColumns.死亡).value)
-            patients = (self.summary_sheet.cell(row=i, column=MainSummaryColumns.陽性者数).value -
-                        self.summary_sheet.cell(row=i - 1, column=MainSummaryColumns.陽性者数).value)
+            discharged = (self.summary_sheet.value(i, MainSummaryColumns.退院) -
+                          self.summary_sheet.value(i - 1, MainSummaryColumns.退院))
+            deaths = (self.summary_sheet.value(i, MainSummaryColumns.死亡) -
+                      self.summary_sheet.value(i - 1, MainSummaryColumns.死亡))
+            patients = (self.summary_sheet.value(i, MainSummaryColumns.陽性者数) -
+                        self.summary_sheet.value(i - 1, MainSummaryColumns.陽性者数))
             # 退院数と死亡数も引かなければ現在患者数にはならないので、そちらをそれぞれ引く
             # なお、Excel内の「入院患者数」(=現在患者数)は式のため、独自に計算している
             self._current_patients_json["data"].append(
                 make_data(date.replace(tzinfo=jst).isoformat(), patients - (discharged + deaths))
             )
 
+    @register_product()
     def make_positive_or_negative(self) -> None:
         # positive_or_negative.jsonを生成する
         self._positive_or_negative_json = self.json_template_of_inspections()
+        # 7日間の陽性数と陰性数の合計を、1日ずつずらしながら求める
+        window = RollingWindow(7, ["陽性数", "陰性数"])
 
         for i in range(inspections_first_row, self.inspections_count):
-            date = self.inspections_sheet.cell(row=i, column=InspectionsColumns.年月日).value.replace(tzinfo=jst)
+            date = self.inspections_sheet.value(i, InspectionsColumns.年月日).replace(tzinfo=jst)
             data = {"日付": date.isoformat()}
             # それぞれの数値を取得し、Noneの場合は0で置き換える
-            official_pcr = self.inspections_sheet.cell(row=i, column=InspectionsColumns.地方衛生研究所PCR).value or 0
-            unofficial_pcr = self.inspections_sheet.cell(row=i, column=InspectionsColumns.民間検査機関PCR).value or 0
-            unofficial_antigen = self.inspections_sheet.cell(row=i, column=InspectionsColumns.民間検査機関抗原).value or 0
-            positive = self.inspections_sheet.cell(row=i, column=InspectionsColumns.陽性件数).value or 0
+            official_pcr = self.inspections_sheet.value(i, InspectionsColumns.地方衛生研究所PCR) or 0
+            unofficial_pcr = self.inspections_sheet.value(i, InspectionsColumns.民間検査機関PCR) or 0
+            unofficial_antigen = self.inspections_sheet.value(i, InspectionsColumns.民間検査機関抗原) or 0
+            positive = self.inspections_sheet.value(i, InspectionsColumns.陽性件数) or 0
 
             negative = official_pcr + unofficial_pcr + unofficial_antigen - positive
 
-            data_len = len(self._positive_or_negative_json["data"])
             data["陽性数"] = positive
             data["陰性数"] = negative
+            window.append(data)
 
-            if data_len < 6:
+            if not window.is_full():
                 positive_average = None
                 positive_rate = None
             else:
-                week_history = self._positive_or_negative_json["data"][-6:]
-                week_history.append(data)
-                positive_total = 0
-                negative_total = 0
-                for day_date in week_history:
-                    positive_total += day_date["陽性数"]
-                    negative_total += day_date["陰性数"]
+                positive_total = window.sum("陽性数")
+                negative_total = window.sum("陰性数")
                 try:
-                    positive_average = round(positive_total / 7, 1)
-                    positive_rate = round(((positive_total / 7) / ((positive_total + negative_total) / 7)) * 100, 1)
+                    positive_average = round(positive_total / window.length, 1)
+                    positive_rate = round(
+                        ((positive_total / window.length) / ((positive_total + negative_total) / window.length)) * 100,
+                        1
+                    )
                 except ZeroDivisionError:
                     positive_average = 0.0
                     positive_rate = 0.0
@@ -620,6 +772,7 @@ class DataManager:
 
             self._positive_or_negative_json["data"].append(data)
 
+    @register_product("positive_or_negative")
     def make_warning_and_phase(self) -> None:
         # warning_and_phase.jsonを生成する
         self._warning_and_phase_json = {
@@ -634,9 +787,7 @@ class DataManager:
         average_length = len(positive_or_negative_dict["data"])
         latest_average_patients = positive_or_negative_dict["data"][average_length - 1]["7日間平均陽性数"]
 
-        soup = get_html_soup()
-
-        real_page_tags = soup.find_all("p", align="center")
+        real_page_tags = self.top_page.find_all("p", align="center")
 
         for tag in real_page_tags:
             strong = tag.find("strong")
@@ -669,7 +820,7 @@ class DataManager:
     def get_summary_values(self) -> List:
         values = []
         for i in range(MainSummaryColumns.検査実施人数, MainSummaryColumns.退院 + 1):
-            value = self.summary_sheet.cell(row=self.data_count - 1, column=i).value
+            value = self.summary_sheet.value(self.data_count - 1, i)
             values.append(value)
         # 最初のデータが抜けていることがあるので別のところから補完
         if values[0] is None:
@@ -690,48 +841,25 @@ class DataManager:
                 self.set_summary_values(child)
 
     def get_patients_last_update(self) -> str:
+        return self.patients_last_update
+
+    def find_patients_last_update(self) -> str:
         # patients_sheets[0]から"M/D H時現在"の形式で記載されている最終更新日時を取得する
-        # クラスターが増えれば端に寄っていき、固定値にすると取得できないので、whileで探索させている
-        # また、ファイルによって表記されている行が違うことがあるので、初めに1行目を100列探索させて、見つからなければ次の行を探索させている
-        column_num = 10
-        data_time_str = ""
-        row_num = 1
-        while not data_time_str:
-            date_time_value = self.patients_sheets[0].cell(row=row_num, column=column_num).value
-            if not date_time_value:
-                column_num += 1
-                if column_num > 100:
-                    column_num = 16
-                    row_num += 1
-                continue
-            # 式(TODAY()-1)が含まれている場合はdatatime型で取得され、時間が別の枠にあるのでそれを取得する
-            if isinstance(date_time_value, datetime):
-                hour_str = ""
-                additional_column_num = 1
-                while not hour_str:
-                    hour_value = self.patients_sheets[0].cell(row=row_num, column=column_num + additional_column_num).value
-                    if not hour_value:
-                        additional_column_num += 1
-                        continue
-                    hour_str = jaconv.z2h(str(hour_value), digit=True, ascii=True)
-                    data_time_str = return_ymd(date_time_value) + f" {hour_str}"
-                break
-            # 数字に全角半角が混じっていることがあるので、半角に統一
-            data_time_str = jaconv.z2h(str(date_time_value), digit=True, ascii=True)
+        # クラスターが増えれば端に寄っていき、ファイルによって表記されている行も違うので、シートの左上の範囲を一度だけ取り出して探す
+        # 見つけた位置はシートのレイアウトごとにキャッシュしておき、次回からはそのセルを直接読む
+        block = self.patients_sheets[0].block(patients_header_rows, patients_header_columns)
+        layout = header_layout(block)
+        locations = load_cached_json("header_locations.json")
+        data_time_str = read_last_update(block, locations[layout]) if layout in locations else ""
+        if not data_time_str:
+            locations[layout] = locate_last_update(block)
+            save_cached_json("header_locations.json", locations)
+            data_time_str = read_last_update(block, locations[layout])
         plus_day = 0
         # datetime.strptimeでは24時は読み取れないため。24時を次の日の0時として扱わせる
-        if data_time_str[-5:] == "24時現在":
-            # 12/31や1/1など、文字数の増減に対応するため、whileで探索させている
-            count = 8
-            while True:
-                try:
-                    day_str, hour_str = data_time_str[-count:].split()
-                    if day_str.startswith("/"):
-                        raise
-                    break
-                except Exception:
-                    count -= 1
-            data_time_str = data_time_str[:-count] + day_str + " 0時現在"
+        midnight = midnight_pattern.match(data_time_str)
+        if midnight:
+            data_time_str = midnight.group(1) + " 0時現在"
             plus_day = 1
 
         last_update = datetime.strptime(data_time_str, "%Y-%m-%d %H時現在") + timedelta(days=plus_day)
@@ -740,9 +868,9 @@ class DataManager:
 
     def get_inspections_last_update(self) -> str:
         # 最終データの日の次の日を最終更新日としている
-        data_time = self.inspections_sheet.cell(
-            row=self.inspections_count - 1, column=InspectionsColumns.年月日
-        ).value + timedelta(days=1)
+        data_time = self.inspections_sheet.value(
+            self.inspections_count - 1, InspectionsColumns.年月日
+        ) + timedelta(days=1)
         return return_date(data_time).isoformat()
 
     def get_summary_last_update(self) -> str:
@@ -754,49 +882,68 @@ class DataManager:
 
         # summary_sheetは一列目が日付、二列目が時間なので、それを読み取って反映させている
         return return_date(
-            self.summary_sheet.cell(row=self.data_count - 1, column=MainSummaryColumns.発表年月日).value +
-            timedelta(hours=int(self.summary_sheet.cell(row=self.data_count - 1, column=MainSummaryColumns.発表時間).value[:-1]))
+            self.summary_sheet.value(self.data_count - 1, MainSummaryColumns.発表年月日) +
+            timedelta(hours=int(self.summary_sheet.value(self.data_count - 1, MainSummaryColumns.発表時間)[:-1]))
         ).isoformat()
 
     def get_patients(self) -> None:
         # 患者データの行数の取得
 
         # 患者データの最初の方に空白行がある場合があるので、それを飛ばす。
-        global patients_first_rows
         for i, patients_sheet in enumerate(self.patients_sheets):
             while patients_sheet:
-                value = patients_sheet.cell(row=patients_first_rows[i], column=PatientsColumns.番号).value
+                value = patients_sheet.value(self.patients_first_rows[i], PatientsColumns.番号)
                 try:
                     int(value)
                     break
                 except Exception:
-                    patients_first_rows[i] += 1
-            self.patients_counts[i] = patients_first_rows[i]
+                    self.patients_first_rows[i] += 1
+            self.patients_counts[i] = self.patients_first_rows[i]
 
-        global exclude_patients
         for i, patients_sheet in enumerate(self.patients_sheets):
             while patients_sheet:
-                value = patients_sheet.cell(row=self.patients_counts[i], column=PatientsColumns.番号).value
+                value = patients_sheet.value(self.patients_counts[i], PatientsColumns.番号)
                 if not value:
                     break
                 else:
                     sub_value_none_count = 0
                     for j in range(1, 6):
-                        sub_value = patients_sheet.cell(
-                            row=self.patients_counts[i], column=PatientsColumns.番号 + j
-                        ).value
+                        sub_value = patients_sheet.value(self.patients_counts[i], PatientsColumns.番号 + j)
                         sub_value_none_count += 0 if sub_value else 1
                         # 欠番と書かれるか、5列空白があれば除外患者として登録する
                         if sub_value == "欠番" or sub_value_none_count == 5:
-                            exclude_patients.append(value)
+                            self.exclude_patients.add(value)
                             break
                     self.patients_counts[i] += 1
 
+    def get_patients_table(self) -> PatientsTable:
+        # patients_sheetsを一度だけ走査し、除外する患者以外のデータをPatientsTableに格納する
+        table = PatientsTable()
+        for i, patients_sheet in enumerate(self.patients_sheets):
+            # 旧ファイル形式(最後のファイル)だけ備考欄の位置がずれているので"2"増やす
+            note_column = PatientsColumns.備考欄 - (0 if i != len(self.patients_sheets) - 1 else 2)
+            for j in range(self.patients_first_rows[i], self.patients_counts[i]):
+                num = patients_sheet.value(j, PatientsColumns.番号)
+                # 除外する患者はパスする
+                if num in self.exclude_patients:
+                    continue
+                table.append(
+                    num,
+                    return_date(patients_sheet.value(j, PatientsColumns.発表日)),
+                    patients_sheet.value(j, PatientsColumns.年代),
+                    patients_sheet.value(j, PatientsColumns.性別),
+                    patients_sheet.value(j, PatientsColumns.居住地),
+                    patients_sheet.value(j, note_column),
+                    patients_sheet.value(j, PatientsColumns.管轄),
+                    patients_sheet.value(j, PatientsColumns.発症日)
+                )
+        return table
+
     def get_inspections(self) -> None:
         # 検査データの行数の取得
         while self.inspections_sheet:
             self.inspections_count += 1
-            value = self.inspections_sheet.cell(row=self.inspections_count, column=InspectionsColumns.年月日).value
+            value = self.inspections_sheet.value(self.inspections_count, InspectionsColumns.年月日)
             if not value:
                 break
 
@@ -804,20 +951,66 @@ class DataManager:
         # サマリーデータの行数の取得
         while self.summary_sheet:
             self.data_count += 1
-            value = self.summary_sheet.cell(row=self.data_count, column=MainSummaryColumns.発表年月日).value
+            value = self.summary_sheet.value(self.data_count, MainSummaryColumns.発表年月日)
             if not value:
                 break
 
 
 class DataValidator:
-    def __init__(self, patients_sheet: Worksheet, inspections_sheet: Worksheet, summary_sheet: Worksheet):
-        # データファイルの設定
-        self.patients_sheet = patients_sheet
-        self.inspections_sheet = inspections_sheet
-        self.summary_sheet = summary_sheet
-        self.inspections_count = inspections_first_row
-        self.slack_webhook = os.environ["SLACK_WEBHOOK"]
-        self.get_inspections()
+    # 居住地として想定される表記の末尾と、それ以外に許容する表記
+    residence_suffixes = ("市", "町", "都", "道", "府", "県", "市外", "県外", "健康福祉事務所管内")
+    residence_exceptions = ["調査中", "非公表"]
+    sexes = ["男性", "女性", "非公表"]
+    ages = [age_display_unpublished, f"{10}{age_display_min}", f"{90}{age_display_max}"]
+    # 現状判明している管轄(どうやら健康福祉事務所だけではないらしい)
+    # 新たなものは分かり次第追加する
+    jurisdictions = [
+        "芦屋", "宝塚", "伊丹", "加古川", "加東", "中播磨", "龍野", "赤穂",
+        "豊岡", "朝来", "丹波", "洲本", "神戸", "姫路", "尼崎", "西宮", "明石"
+    ]
+    onset_date_exceptions = ["症状なし", "調査中", "非公表"]
+    # 陽性者数累計の内訳の欄
+    confirmed_cases_columns = [
+        MainSummaryColumns.入院中, MainSummaryColumns.宿泊療養, MainSummaryColumns.入院宿泊療養調整等,
+        MainSummaryColumns.自宅療養, MainSummaryColumns.その他, MainSummaryColumns.死亡, MainSummaryColumns.退院
+    ]
+    # サマリーの検証で読む欄
+    summary_checked_columns = [
+        MainSummaryColumns.陽性者数, MainSummaryColumns.中等症以下, MainSummaryColumns.重症
+    ] + confirmed_cases_columns
+
+    def __init__(self, data_manager: DataManager):
+        # DataManagerが読み込んだテーブルや索引をそのまま使い、シートを読み直さないようにする
+        self.patients_table = data_manager.patients_table
+        self.patients_sheets = data_manager.patients_sheets
+        self.patients_first_rows = data_manager.patients_first_rows
+        self.patients_counts = data_manager.patients_counts
+        self.inspections_sheet = data_manager.inspections_sheet
+        self.summary_sheet = data_manager.summary_sheet
+        self.inspections_count = data_manager.inspections_count
+        self.data_count = data_manager.data_count
+        self.inspections_date_rows = data_manager.inspections_date_rows
+        self.summary_date_rows = self.summary_sheet.date_index(
+            MainSummaryColumns.発表年月日, main_summary_first_row, self.data_count
+        )
+        # 除外された患者番号の集合(DataManagerが作成したものを受け取る)
+        self.exclude_patients = data_manager.exclude_patients
+        self.slack_webhook = os.environ.get("SLACK_WEBHOOK", "")
+        # 見つかった警告。(日付や患者番号, シート, ルール)のタプルをキーとする
+        # シートをまたいだ検証では、このキーで他のシートの警告を引く
+        self.warnings = {}
+
+    def add_warning(self, subject: str, sheet: str, rule: str, message: str, file: str) -> None:
+        self.warnings[(subject, sheet, rule)] = {
+            # 警告を識別するためのID。メッセージ中の差分などが変わっても同じ警告として扱えるよう、キーから作る
+            "id": f"{sheet}:{rule}:{subject}",
+            "message": message,
+            "file": file,
+            "fixed": False
+        }
+
+    def has_warning(self, subject: str, sheet: str, rule: str) -> bool:
+        return (subject, sheet, rule) in self.warnings
 
     def check_all_data(self) -> str:
         result_variation = [
@@ -829,54 +1022,82 @@ class DataValidator:
             "No new data warnings were found."
         ]
 
-        sheet_list = [
-            member[0] for member in inspect.getmembers(self) if member[0][:5] == "check" and member[0][-5:] == "sheet"
-        ]
-        warnings = []
+        # シートをまたいだ検証では前の検証の警告を参照するので、登録された検証を依存先から順に一度ずつ行う
+        self.warnings = {}
+        for name in resolve_order(rules, list(rules)):
+            print_log("data_validator", f"Run check_{name}...")
+            with measure("check", name):
+                getattr(self, "check_" + name)()
+        warnings = {warning["id"]: warning for warning in self.warnings.values()}
         result = result_variation[5]
         slack_message = ""
-        for sheet in sheet_list:
-            print_log("data_validator", f"Run {sheet}...")
-            # evalで文字列から関数を呼び出している
-            warnings += eval("self." + sheet + "()")
+        today = datetime.now(jst).strftime("%Y-%m-%d")
 
         now_warnings = requests_now_data_json("open_data_warnings.json")
         if not now_warnings:
             now_warnings = []
-
-        fixed_count = 0
-        already_fixed_count = 0
+        # 以前の警告をIDをキーとする辞書にする
+        # IDを持たない古い形式の警告は、メッセージが一致する今回の警告のIDを割り当てる
+        message_ids = {warning["message"]: warning_id for warning_id, warning in warnings.items()}
+        prev_warnings = {}
         for warning in now_warnings:
-            message = warning["message"]
-            warnings_message = [w["message"] for w in warnings]
-            if message in warnings_message:
-                w_index = warnings_message.index(message)
-                warnings.pop(w_index)
-            elif not warning["fixed"]:
-                warning["fixed"] = True
-                fixed_count += 1
+            warning_id = warning.get("id") or message_ids.get(warning["message"]) or "message:" + warning["message"]
+            warning["id"] = warning_id
+            prev_warnings[warning_id] = warning
+
+        # 集合演算で、新たな警告、解決された警告、解決済みの警告、まだ残っている警告に分ける
+        prev_open_ids = {warning_id for warning_id, warning in prev_warnings.items() if not warning["fixed"]}
+        prev_fixed_ids = prev_warnings.keys() - prev_open_ids
+        new_ids = warnings.keys() - prev_open_ids
+        fixed_ids = prev_open_ids - warnings.keys()
+        still_open_ids = prev_open_ids & warnings.keys()
+        already_fixed_ids = prev_fixed_ids - warnings.keys()
+
+        for warning_id in still_open_ids:
+            # メッセージ(差分の値など)は最新のものに更新する
+            prev_warnings[warning_id].update(message=warnings[warning_id]["message"], file=warnings[warning_id]["file"])
+        for warning_id in fixed_ids:
+            prev_warnings[warning_id]["fixed"] = True
+            prev_warnings[warning_id]["fixed_at"] = today
+        for warning_id in already_fixed_ids:
+            prev_warnings[warning_id].setdefault("fixed_at", today)
+        # 新たな警告は、検証した順(シートの順)に並べる
+        for warning_id in (warning_id for warning_id in warnings if warning_id in new_ids):
+            # 一度解決された警告が再び見つかった場合も、新たな警告として扱う
+            prev_warnings.pop(warning_id, None)
+            prev_warnings[warning_id] = dict(warnings[warning_id], found_at=today)
+
+        # 解決されてから一定の日数が経った警告は、別のファイルに移して警告のファイルを小さく保つ
+        archive_date = return_ymd(datetime.now(jst) - timedelta(days=warnings_archive_days))
+        archived_warnings = []
+        new_warnings = []
+        for warning in prev_warnings.values():
+            if warning["fixed"] and warning["fixed_at"] < archive_date:
+                archived_warnings.append(warning)
             else:
-                already_fixed_count += 1
-
-        new_warnings = now_warnings + warnings
+                new_warnings.append(warning)
+        # デプロイの際にgh-pagesブランチは./dataで置き換えられるので、移す警告がなくても毎回出力する
+        print_log("data_validator", f"Archive {len(archived_warnings)} fixed warnings.")
+        dumps_json(
+            "open_data_warnings_archive.json",
+            (requests_now_data_json("open_data_warnings_archive.json") or []) + archived_warnings
+        )
 
         dumps_json("open_data_warnings.json", new_warnings)
-        if warnings and fixed_count:
-            slack_message = f"{fixed_count}個の警告が解決され、新たに{len(warnings)}個の警告が見つかりました。"
+        if new_ids and fixed_ids:
+            slack_message = f"{len(fixed_ids)}個の警告が解決され、新たに{len(new_ids)}個の警告が見つかりました。"
             result = result_variation[2]
-        elif warnings:
-            slack_message = f"新たに{len(warnings)}個の警告が見つかりました。"
+        elif new_ids:
+            slack_message = f"新たに{len(new_ids)}個の警告が見つかりました。"
             result = result_variation[0]
-        elif fixed_count == len(new_warnings) - already_fixed_count:
+        elif fixed_ids and not still_open_ids:
             slack_message = "すべての警告が解決されました。"
             result = result_variation[3]
-        elif fixed_count:
-            slack_message = f"{fixed_count}個の警告が解決されましたが、まだいくつかの警告が残っています。"
+        elif fixed_ids:
+            slack_message = f"{len(fixed_ids)}個の警告が解決されましたが、まだいくつかの警告が残っています。"
             result = result_variation[1]
-        elif already_fixed_count < len(new_warnings):
+        elif still_open_ids:
             result = result_variation[4]
-        elif already_fixed_count == len(new_warnings):
-            result = result_variation[5]
         if slack_message:
             if slack_message != "すべての警告が解決されました。":
                 slack_message += (
@@ -886,301 +1107,374 @@ class DataValidator:
             self.slack_notify(slack_message)
         return result
 
-    def check_patients_sheet(self) -> List:
+    @register_rule()
+    def check_patients_sheet(self) -> None:
         # データ数がほかのデータと相違ないか、データ形式が間違っていないか
-        patients_warning = []
-        patients_column = patients_first_row
-        count = 1
-        patients_count = 0
-        prev_date = None
-
-        def add_warning_message(message: str, option_file: str = ""):
-            patients_warning.append(
-                {
-                    "message": message,
-                    "file": "patients" + (f", {option_file}" if option_file else ""),
-                    "fixed": False
-                }
-            )
+        table = self.patients_table
 
-        # 全体として、データ数の確認数をする
-        while True:
-            num = self.patients_sheet.cell(row=patients_column, column=PatientsColumns.番号).value
-            prev_num = self.patients_sheet.cell(row=patients_column - 1, column=PatientsColumns.番号).value
-            if isinstance(prev_num, int) and isinstance(num, int):
-                if prev_num - 1 != num:
-                    add_warning_message(
+        # 患者番号が連続しているか(除外された患者の行も含めて、シートの行の順に上の行の番号と比べる)
+        # 重複した行や順番が入れ替わった行も見つけられるよう、並べ替えずに比べる
+        # 同じ番号の行が複数あっても警告が一つにまとめられないよう、上の行の番号と合わせて警告を識別する
+        prev_num = None
+        for i, patients_sheet in enumerate(self.patients_sheets):
+            for row in range(self.patients_first_rows[i], self.patients_counts[i]):
+                num = patients_sheet.value(row, PatientsColumns.番号)
+                if isinstance(prev_num, int) and isinstance(num, int) and prev_num - 1 != num:
+                    self.add_warning(
+                        f"{prev_num}-{num}", "patients", "number",
                         f"{num}番の患者番号に間違いがある可能性があります。" +
-                        f"上の行の番号との差が1ではありません(上の行の番号:{prev_num})"
-                    )
-            if num in exclude_patients:
-                patients_column += 1
-                continue
-            if num is not None:
-                date = return_date(self.patients_sheet.cell(row=patients_column, column=PatientsColumns.発表日).value)
-                # ここで、データ単体の確認をする
-                # 居住地がおかしくないか
-                residence = self.patients_sheet.cell(row=patients_column, column=PatientsColumns.居住地).value
-                if not residence.endswith(("市", "町", "都", "道", "府", "県", "市外", "県外", "健康福祉事務所管内")):
-                    if residence not in ["調査中", "非公表"]:
-                        add_warning_message(
-                            f"{num}番の患者データに間違いがある可能性があります。" +
-                            f"居住地が定型に当てはまっていません({residence})"
-                        )
-                # 性別はおかしくないか
-                sex = self.patients_sheet.cell(row=patients_column, column=PatientsColumns.性別).value
-                if sex not in ["男性", "女性", "非公表"]:
-                    add_warning_message(
-                        f"{num}番の患者データに間違いがある可能性があります。" +
-                        f"性別が不適切です({sex})"
-                    )
-                # 年代はおかしくないか
-                age = self.patients_sheet.cell(row=patients_column, column=PatientsColumns.年代).value
-                # なぜか文字列型の数字が含まれ、誤データ扱いされるので、修正
-                try:
-                    age = int(age)
-                except Exception:
-                    pass
-                if isinstance(age, str):
-                    if age in [age_display_unpublished, f"{10}{age_display_min}", f"{90}{age_display_max}"]:
-                        pass
-                    else:
-                        add_warning_message(
-                            f"{num}番の患者データに間違いがある可能性があります。" +
-                            f"年代が不適切です({age})"
-                        )
-                elif isinstance(age, int):
-                    pass
-                else:
-                    add_warning_message(
-                        f"{num}番の患者データに間違いがある可能性があります。" +
-                        f"年代が不適切です({age})"
-                    )
-                # 管轄はおかしくないか
-                jurisdiction = str(self.patients_sheet.cell(row=patients_column, column=PatientsColumns.管轄).value)
-                # 現状判明している管轄(どうやら健康福祉事務所だけではないらしい)
-                # 新たなものは分かり次第追加する
-                if jurisdiction not in [
-                    "芦屋", "宝塚", "伊丹", "加古川", "加東", "中播磨", "龍野", "赤穂",
-                    "豊岡", "朝来", "丹波", "洲本", "神戸", "姫路", "尼崎", "西宮", "明石"
-                ]:
-                    add_warning_message(
-                        f"{num}番の患者データに間違いがある可能性があります。" +
-                        f"管轄が不適切です({jurisdiction})"
+                        f"上の行の番号との差が1ではありません(上の行の番号:{prev_num})",
+                        "patients"
                     )
-                # 発症日はおかしくないか
-                onset_date = self.patients_sheet.cell(row=patients_column, column=PatientsColumns.発症日).value
-                if return_date(onset_date) is None:
-                    if onset_date not in ["症状なし", "調査中", "非公表"]:
-                        add_warning_message(
-                            f"{num}番の患者データに間違いがある可能性があります。" +
-                            f"発症日が不適切です({onset_date})"
-                        )
-            else:
-                date = None
-            inspections_last_date = return_date(
-                self.inspections_sheet.cell(row=self.inspections_count - 1, column=1).value
-            )
-            if prev_date is None or prev_date == date:
-                patients_count += 1
-            elif inspections_last_date < prev_date:
-                # inspections_sheetの公開がpatients_sheetの公開より遅い場合は、同じ日のデータが見つけられないので検証をパスする
-                # なお、patients_countを1にするのはprev_dateがinspections_last_dateと同じ日になった時のため(elseの時と同じ処理)
-                patients_count = 1
-            else:
-                # 感染者0の日もあるので、感染者があった日のデータに合うようにする
-                while prev_date != return_date(
-                        self.inspections_sheet.cell(row=self.inspections_count - count, column=1).value
-                ):
-                    count += 1
-
-                patients_count_from_inspections_sheet = self.inspections_sheet.cell(
-                    row=self.inspections_count - count, column=6
-                ).value
-                if patients_count != patients_count_from_inspections_sheet:
-                    add_warning_message(
-                        f"患者データの{return_ymd(prev_date)}の分に間違いがある可能性があります。" +
-                        f"小計が合いません(差分:{patients_count_from_inspections_sheet - patients_count})",
-                        "inspections"
-                    )
-                if date is None:
-                    break
-                patients_count = 1
-            prev_date = date
-            patients_column += 1
+                prev_num = num
+
+        # データ単体の確認をしつつ、日ごとの患者数を数える
+        patients_counts = {}
+        for i in range(len(table)):
+            num = table.numbers[i]
+            release_date = table.release_dates[i]
+            if release_date is not None:
+                patients_counts[release_date.date()] = patients_counts.get(release_date.date(), 0) + 1
+
+            # 居住地がおかしくないか
+            residence = table.residences[i]
+            if not residence.endswith(self.residence_suffixes) and residence not in self.residence_exceptions:
+                self.add_warning(
+                    str(num), "patients", "residence",
+                    f"{num}番の患者データに間違いがある可能性があります。" +
+                    f"居住地が定型に当てはまっていません({residence})",
+                    "patients"
+                )
+            # 性別はおかしくないか
+            sex = table.sexes[i]
+            if sex not in self.sexes:
+                self.add_warning(
+                    str(num), "patients", "sex",
+                    f"{num}番の患者データに間違いがある可能性があります。" +
+                    f"性別が不適切です({sex})",
+                    "patients"
+                )
+            # 年代はおかしくないか
+            age = table.raw_ages[i]
+            # なぜか文字列型の数字が含まれ、誤データ扱いされるので、修正
+            try:
+                age = int(age)
+            except Exception:
+                pass
+            if not isinstance(age, int) and not (isinstance(age, str) and age in self.ages):
+                self.add_warning(
+                    str(num), "patients", "age",
+                    f"{num}番の患者データに間違いがある可能性があります。" +
+                    f"年代が不適切です({age})",
+                    "patients"
+                )
+            # 管轄はおかしくないか
+            jurisdiction = str(table.jurisdictions[i])
+            if jurisdiction not in self.jurisdictions:
+                self.add_warning(
+                    str(num), "patients", "jurisdiction",
+                    f"{num}番の患者データに間違いがある可能性があります。" +
+                    f"管轄が不適切です({jurisdiction})",
+                    "patients"
+                )
+            # 発症日はおかしくないか
+            onset_date = table.onset_dates[i]
+            if return_date(onset_date) is None and onset_date not in self.onset_date_exceptions:
+                self.add_warning(
+                    str(num), "patients", "onset_date",
+                    f"{num}番の患者データに間違いがある可能性があります。" +
+                    f"発症日が不適切です({onset_date})",
+                    "patients"
+                )
 
-        patients_warning.reverse()
-        return patients_warning
+        # 日ごとの患者数が、inspections_sheetの陽性件数と合っているか
+        inspections_last_date = return_date(
+            self.inspections_sheet.value(self.inspections_count - 1, InspectionsColumns.年月日)
+        ).date()
+        for day, patients_count in sorted(patients_counts.items()):
+            # inspections_sheetの公開がpatients_sheetの公開より遅い場合は、同じ日のデータが見つけられないので検証をパスする
+            if inspections_last_date < day:
+                continue
+            row = self.inspections_date_rows.get(day)
+            patients_count_from_inspections_sheet = 0
+            if row is not None:
+                patients_count_from_inspections_sheet = self.inspections_sheet.value(row, InspectionsColumns.陽性件数) or 0
+            if patients_count != patients_count_from_inspections_sheet:
+                self.add_warning(
+                    return_ymd(day), "patients", "daily_count",
+                    f"患者データの{return_ymd(day)}の分に間違いがある可能性があります。" +
+                    f"小計が合いません(差分:{patients_count_from_inspections_sheet - patients_count})",
+                    "patients, inspections"
+                )
 
-    def check_inspections_sheet(self) -> List:
-        inspections_warning = []
-        inspections_row = inspections_first_row
+    @register_rule("patients_sheet")
+    def check_inspections_sheet(self) -> None:
         inspections_total = 0
         patients_total = 0
-        count = 0
-
-        patients_warnings = [m["message"] for m in self.check_patients_sheet()]
-
-        def add_warning_message(message: str, option_file: str = "", only_option_file: bool = False):
-            inspections_warning.append(
-                {
-                    "message": message,
-                    "file": ("inspections" if not only_option_file else "") +
-                            (f"{', ' if not only_option_file else ''}{option_file}" if option_file else ""),
-                    "fixed": False
-                }
-            )
+        summary_first_date = return_date(
+            self.summary_sheet.value(main_summary_first_row, MainSummaryColumns.発表年月日)
+        )
+        summary_last_date = max(self.summary_date_rows) if self.summary_date_rows else None
 
-        while True:
-            date = return_date(self.inspections_sheet.cell(row=inspections_row, column=1).value)
-            summary_date = return_date(
-                self.summary_sheet.cell(row=main_summary_first_row + count, column=MainSummaryColumns.発表年月日).value
-            )
-            if summary_date is None or date is None:
+        for inspections_row in range(inspections_first_row, self.inspections_count):
+            date = return_date(self.inspections_sheet.value(inspections_row, InspectionsColumns.年月日))
+            if date is None:
                 break
+            ymd = return_ymd(date)
 
             # データの取得
-            inspections_subtotal = self.inspections_sheet.cell(row=inspections_row, column=2).value or 0
-            official_pcr = self.inspections_sheet.cell(row=inspections_row, column=3).value or 0
-            unofficial_pcr = self.inspections_sheet.cell(row=inspections_row, column=4).value or 0
-            unofficial_antigen = self.inspections_sheet.cell(row=inspections_row, column=5).value or 0
-            patients_in_day = self.inspections_sheet.cell(row=inspections_row, column=6).value or 0
+            inspections_subtotal = self.inspections_sheet.value(inspections_row, InspectionsColumns.検査数合計) or 0
+            official_pcr = self.inspections_sheet.value(inspections_row, InspectionsColumns.地方衛生研究所PCR) or 0
+            unofficial_pcr = self.inspections_sheet.value(inspections_row, InspectionsColumns.民間検査機関PCR) or 0
+            unofficial_antigen = self.inspections_sheet.value(inspections_row, InspectionsColumns.民間検査機関抗原) or 0
+            patients_in_day = self.inspections_sheet.value(inspections_row, InspectionsColumns.陽性件数) or 0
             subtotal = official_pcr + unofficial_pcr + unofficial_antigen
 
             if inspections_subtotal != subtotal:
-                add_warning_message(
-                    f"{return_ymd(date)}の検査数に間違いがある可能性があります。" +
-                    f"小計(1日ごとの合計)が合いません(差分:{inspections_subtotal - subtotal})"
+                self.add_warning(
+                    ymd, "inspections", "subtotal",
+                    f"{ymd}の検査数に間違いがある可能性があります。" +
+                    f"小計(1日ごとの合計)が合いません(差分:{inspections_subtotal - subtotal})",
+                    "inspections"
                 )
 
             inspections_total += inspections_subtotal
             patients_total += patients_in_day
 
-            inspections_row += 1
-
             # summary_sheetの最初のデータの日付まではinspections_sheet単体でのデータ検証を行う
-            summary_first_date = return_date(
-                self.summary_sheet.cell(row=main_summary_first_row, column=MainSummaryColumns.発表年月日).value
-            )
             if date < summary_first_date:
                 continue
+            # summary_sheetの最後のデータの日付を過ぎれば終了する
+            if summary_last_date is None or date.date() > summary_last_date:
+                break
+            # 同じ日付のsummary_sheetの行を索引から引く。途中の日付の行がない場合も、累計は数え続ける
+            summary_row = self.summary_date_rows.get(date.date())
+            if summary_row is None:
+                continue
 
-            summary_inspections = self.summary_sheet.cell(
-                row=main_summary_first_row + count, column=MainSummaryColumns.検査実施人数
-            ).value
-            summary_patients = self.summary_sheet.cell(
-                row=main_summary_first_row + count, column=MainSummaryColumns.陽性者数
-            ).value
+            summary_inspections = self.summary_sheet.value(summary_row, MainSummaryColumns.検査実施人数)
+            summary_patients = self.summary_sheet.value(summary_row, MainSummaryColumns.陽性者数)
             if summary_inspections is None:
-                add_warning_message(
-                    f"{return_ymd(date)}の検査件数累計データが存在しません",
-                    "summary"
+                self.add_warning(
+                    ymd, "inspections", "inspections_total",
+                    f"{ymd}の検査件数累計データが存在しません",
+                    "inspections, summary"
                 )
             elif inspections_total != summary_inspections:
-                add_warning_message(
-                    f"{return_ymd(date)}の検査件数に間違いがある可能性があります。" +
+                self.add_warning(
+                    ymd, "inspections", "inspections_total",
+                    f"{ymd}の検査件数に間違いがある可能性があります。" +
                     f"累計が合いません(差分:{summary_inspections - inspections_total})",
+                    "inspections, summary"
+                )
+            # 同じ日の患者データに警告がある場合は、そちらが原因と考えられるので警告しない
+            if patients_total != summary_patients and not self.has_warning(ymd, "patients", "daily_count"):
+                self.add_warning(
+                    ymd, "summary", "patients_total",
+                    f"{ymd}の陽性件数に間違いがある可能性があります。" +
+                    f"累計が合いません(差分:{summary_patients - patients_total})",
                     "summary"
                 )
-            if patients_total != summary_patients:
-                option_file = "summary"
-                only_option_file = True
-
-                for warning in patients_warnings:
-                    if return_ymd(date) in warning:
-                        option_file = ""
-                if option_file:
-                    add_warning_message(
-                        f"{return_ymd(date)}の陽性件数に間違いがある可能性があります。" +
-                        f"累計が合いません(差分:{summary_patients - patients_total})",
-                        option_file,
-                        only_option_file
-                    )
-            count += 1
-        return inspections_warning
-
-    def check_summary_sheet(self) -> List:
-        summary_warning = []
-        summary_row = main_summary_first_row
-
-        def add_warning_message(message: str, option_file: str = ""):
-            summary_warning.append(
-                {
-                    "message": message,
-                    "file": "summary" + (f", {option_file}" if option_file else ""),
-                    "fixed": False
-                }
-            )
 
-        while True:
-            date = return_date(self.summary_sheet.cell(row=summary_row, column=MainSummaryColumns.発表年月日).value)
+    @register_rule()
+    def check_summary_sheet(self) -> None:
+        for summary_row in range(main_summary_first_row, self.data_count):
+            date = return_date(self.summary_sheet.value(summary_row, MainSummaryColumns.発表年月日))
             if date is None:
                 break
+            ymd = return_ymd(date)
+
+            # 入院調整中欄。その他医療機関等福祉施設欄などは"-"が含まれているので、str型のものを0に変換する
+            # 空欄は0とはみなさず、値がないことを警告してその行の検証は行わない
+            # 疑似症患者数と入院調整はどちらの検証にも使わないので、空欄でも構わない
+            values = {}
+            missing_columns = []
+            for column in MainSummaryColumns:
+                if column not in self.summary_checked_columns:
+                    continue
+                value = self.summary_sheet.value(summary_row, column)
+                if value is None:
+                    missing_columns.append(column.name)
+                values[column] = 0 if isinstance(value, str) else value
+            if missing_columns:
+                self.add_warning(
+                    ymd, "summary", "missing",
+                    f"{ymd}時点のデータに値がない欄があります({'、'.join(missing_columns)})",
+                    "summary"
+                )
+                continue
 
-            (
-                confirmed_cases,
-                hospitalized,
-                mild,
-                severe,
-                home_recuperation,
-                awaiting_hospitalization,
-                _,
-                other,
-                death,
-                discharged
-            ) = self.get_summary_values(summary_row)
-
-            # 入院調整中欄。その他医療機関等福祉施設欄は"-"が含まれているので、str型のものを0に変換する
-            if isinstance(awaiting_hospitalization, str):
-                awaiting_hospitalization = 0
-            if isinstance(other, str):
-                other = 0
             # 入院患者数の検証
-            if hospitalized != mild + severe:
-                add_warning_message(
-                    f"{return_ymd(date)}時点の入院患者数に間違いがある可能性があります。" +
-                    f"中等症者と重症者の合計と入院患者数が合いません(差分:{hospitalized - (mild + severe)})"
+            hospitalized = values[MainSummaryColumns.入院中]
+            mild_and_severe = values[MainSummaryColumns.中等症以下] + values[MainSummaryColumns.重症]
+            if hospitalized != mild_and_severe:
+                self.add_warning(
+                    ymd, "summary", "hospitalized",
+                    f"{ymd}時点の入院患者数に間違いがある可能性があります。" +
+                    f"中等症者と重症者の合計と入院患者数が合いません(差分:{hospitalized - mild_and_severe})",
+                    "summary"
                 )
             # 陽性者数の検証
-            total = hospitalized + home_recuperation + awaiting_hospitalization + other + death + discharged
+            confirmed_cases = values[MainSummaryColumns.陽性者数]
+            total = sum(values[column] for column in self.confirmed_cases_columns)
             if confirmed_cases != total:
-                add_warning_message(
-                    f"{return_ymd(date)}時点の陽性者数累計に間違いがある可能性があります。" +
-                    "陽性者数累計とその他(入院患者数、自宅療養者数、死者数、退院者数)の合計が合いません" +
-                    f"(差分:{confirmed_cases - total})"
+                self.add_warning(
+                    ymd, "summary", "confirmed_cases",
+                    f"{ymd}時点の陽性者数累計に間違いがある可能性があります。" +
+                    "陽性者数累計とその他(入院患者数、宿泊療養者数、入院・宿泊療養調整等、自宅療養者数、" +
+                    "その他医療機関福祉施設等、死者数、退院者数)の合計が合いません" +
+                    f"(差分:{confirmed_cases - total})",
+                    "summary"
                 )
-            summary_row += 1
-
-        return summary_warning
-
-    def get_summary_values(self, row) -> List:
-        values = []
-        for i in range(MainSummaryColumns.陽性者数, MainSummaryColumns.退院 + 1):
-            value = self.summary_sheet.cell(row=row, column=i).value
-            values.append(value)
-        return values
-
-    def get_inspections(self) -> None:
-        # 検査データの行数の取得
-        while self.inspections_sheet:
-            self.inspections_count += 1
-            value = self.inspections_sheet.cell(row=self.inspections_count, column=1).value
-            if not value:
-                break
 
     def slack_notify(self, message: str) -> None:
+        # Webhookが設定されていない(ローカルでの実行など)場合は通知しない
+        if not self.slack_webhook:
+            print_log("data_validator", f"Slack webhook is not set. Skip notification: {message}")
+            return
         requests.post(self.slack_webhook, data=dumps({
             'text': message,
             'username': 'COVID-19 Open Data Validator'
         }))
 
 
-if __name__ == '__main__':
+def work_path(*names: str) -> str:
+    return os.path.join(work_dir, *names)
+
+
+def save_work_json(file_name: str, json_data: Union[Dict, List]) -> None:
+    filename = work_path(file_name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(dumps(json_data, ensure_ascii=False))
+
+
+def load_work_json(file_name: str) -> Dict:
+    filename = work_path(file_name)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r", encoding="utf-8") as f:
+        return loads(f.read())
+
+
+def load_tables(parse: bool = False) -> Tuple[List[SheetTable], SheetTable, SheetTable]:
+    # fetchステージで保存したExcelファイルを読み込み、(患者データ, 検査データ, サマリー)のテーブルを返す
+    # 読み込んだテーブルは保存しておき、parseがFalseであればそれを使う
+    tables_file = work_path("tables.pickle")
+    if not parse and os.path.exists(tables_file):
+        with open(tables_file, "rb") as f:
+            return pickle.load(f)
+    fetched = load_work_json("fetch.json")
+    if not fetched:
+        raise Exception("Fetched files are not found. Run fetch stage first!")
+    print_log("main", "Loading open data...")
+    patients_sheets = [load_sheet_table(filename) for filename in fetched["patients_files"]]
+    summary_sheet, inspections_sheet = [load_sheet_table(filename) for filename in fetched["inspections_files"]]
+    tables = (patients_sheets, inspections_sheet, summary_sheet)
+    with open(tables_file, "wb") as f:
+        pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL)
+    return tables
+
+
+def load_data_manager(parse: bool = False) -> DataManager:
+    with open(work_path("raw", "top.html"), "rb") as f:
+        top_page = parse_html(f.read())
     print_log("main", "Init DataManager")
-    data_manager = DataManager(patients_files, inspections, summary)
+    return DataManager(*load_tables(parse), top_page)
+
+
+def fetch(context: Dict) -> bool:
+    # ネットワークに接続するのはこのステージのみ
+    # Excelファイルと、警戒レベルの判定に使うトップページ、現在デプロイされているjsonを取得してwork_dirに保存する
+    # 入力ファイルのハッシュ値が前回の実行時と全て同じであれば、Falseを返して以降のステージを打ち切らせる
+    raw_dir = work_path("raw")
+    os.makedirs(raw_dir, exist_ok=True)
+    # 前回の実行時の計測結果が混ざらないよう、各ステージの計測結果を消しておく
+    shutil.rmtree(work_path("report"), ignore_errors=True)
+    print_log("main", "Downloading open data...")
+    top_page = get_html()
+    # 各ページは一度だけ読み込み、全てのファイルを並列にダウンロードする
+    files = get_files({patients_page: None, inspections_page: 2}, raw_dir)
+    print_log("main", "Complete download of open data.")
+    with open(work_path("raw", "top.html"), "wb") as f:
+        f.write(top_page)
+    # 前回読み込んだテーブルや生成結果は使えないので消しておく
+    for file_name in ["tables.pickle", "build.json"]:
+        if os.path.exists(work_path(file_name)):
+            os.remove(work_path(file_name))
+
+    # age_summary.jsonなどは実行日までのデータを0で埋めるので、日付もマニフェストに含めている
+    index_urls = [base_url + patients_page, base_url + inspections_page]
+    manifest = {
+        "build_date": datetime.now(jst).strftime("%Y-%m-%d"),
+        "inputs": {url: digest for url, digest in sorted(fetched_digests.items()) if url not in index_urls},
+        "outputs": {}
+    }
+    save_work_json("fetch.json", {
+        "manifest": manifest,
+        "patients_files": files[patients_page],
+        "inspections_files": files[inspections_page]
+    })
+    prev_manifest = load_manifest()
+    if (prev_manifest.get("build_date") == manifest["build_date"] and
+            prev_manifest.get("inputs") == manifest["inputs"]):
+        print_log("main", "Input files have not changed. Skip making files.")
+        set_action_output("skip_deploy", "true")
+        return False
+
+    # 変更検知のために、現在デプロイされているjsonのハッシュ値などを並列にまとめて取得しておく
+    # ハッシュ値のファイルがデプロイされていない場合のみ、比較のためにjsonそのものも取得する
+    # キャッシュに保存したpatients.jsonが使えない場合は、差分で作成するためにデプロイされているものを取得する
+    print_log("main", "Prefetch deployed json files...")
+    prefetch_now_data_jsons(
+        ["digests.json", "last_update.json", "open_data_warnings.json", "open_data_warnings_archive.json"]
+    )
+    now_digests = requests_now_data_json("digests.json")
+    if not now_digests:
+        prefetch_now_data_jsons(DataManager.json_names())
+    elif json_digest(load_cached_json("patients.json")) != now_digests.get("patients.json"):
+        prefetch_now_data_jsons(["patients.json"])
+    save_now_data_jsons(work_path("now_data"))
+    return True
+
+
+def build(context: Dict) -> bool:
+    # 保存したファイルからjsonを生成し、./dataに出力する
+    use_now_data_dir(work_path("now_data"))
+    data_manager = load_data_manager(parse=True)
     changed_flag = data_manager.dump_and_check_all_data()
+    print_log("main", "Make files complete!")
+    save_work_json("build.json", {"changed": changed_flag})
+    context["data_manager"] = data_manager
+    return True
+
+
+def validate(context: Dict) -> bool:
+    # オープンデータを検証し、警告を./dataに出力する
+    use_now_data_dir(work_path("now_data"))
+    print_log("main", "Start open data validation.")
+    data_manager = context.get("data_manager") or load_data_manager()
+    print_log("main", "Init DataValidator")
+    data_validator = DataValidator(data_manager)
+    print_log("main", data_validator.check_all_data())
+    return True
+
+
+def publish(context: Dict) -> bool:
+    # デプロイする./dataを仕上げ、次回の実行のためのマニフェストやキャッシュを保存する
+    use_now_data_dir(work_path("now_data"))
+    # 今回取得したファイルからbuildステージでjsonを生成していなければ、./dataには前回の出力が残っているので公開しない
+    fetched = load_work_json("fetch.json")
+    if not fetched:
+        raise Exception("Fetched files are not found. Run fetch stage first!")
+    build_file = work_path("build.json")
+    if not os.path.exists(build_file) or os.path.getmtime(build_file) < os.path.getmtime(work_path("fetch.json")):
+        raise Exception("Build stage has not been completed after the latest fetch stage!")
+    # ダウンロードしたExcelファイルも、これまで通りデプロイする
+    for filename in fetched["patients_files"] + fetched["inspections_files"]:
+        shutil.copyfile(filename, os.path.join("./data", os.path.basename(filename)))
     # 変更が検知されればlast_update.jsonを生成する
-    if changed_flag:
+    if load_work_json("build.json").get("changed"):
         last_update = {
             "last_update": datetime.now(jst).strftime("%Y-%m-%dT%H:%M:00+09:00")
         }
@@ -1188,9 +1482,52 @@ if __name__ == '__main__':
         last_update = requests_now_data_json("last_update.json")
     print_log("main", "Make last_update.json...")
     dumps_json("last_update.json", last_update)
-    print_log("main", "Make files complete!")
-    print_log("main", "Start open data validation.")
-    print_log("main", "Init DataValidator")
-    # DataValidatorは正常に動作しないため。停止中
-    # data_validator = DataValidator(patients, inspections, summary)
-    # print_log("main", data_validator.check_all_data())
+    # 各処理の所要時間とメモリ使用量を出力する
+    # 今回のfetchステージ以降に実行したステージの計測結果と、ここまでのpublishステージの計測結果をまとめる
+    report = {}
+    for name in stages:
+        if name == "publish":
+            report[name] = list(run_report)
+        elif os.path.exists(work_path("report", name + ".json")):
+            report[name] = load_work_json(os.path.join("report", name + ".json"))
+    dumps_json("run_report.json", {"build_date": fetched["manifest"]["build_date"], "stages": report})
+    # 出力ファイルのハッシュ値も記録し、マニフェストを保存する
+    manifest = fetched["manifest"]
+    for file_name in sorted(os.listdir("./data")):
+        if file_name.endswith(".json"):
+            manifest["outputs"][file_name] = file_digest("./data/" + file_name)
+    save_manifest(manifest)
+    # 次回patients.jsonを差分で作成する際に、デプロイされているものを取得しなくて済むようにキャッシュに保存しておく
+    save_cached_json("patients.json", loads_json("patients.json", "data"))
+    return True
+
+
+# 実行するステージ。引数を指定しなければ全てのステージを順に実行する
+stages = {
+    "fetch": fetch,
+    "build": build,
+    "validate": validate,
+    "publish": publish
+}
+
+
+def run_stages(names: List[str]) -> None:
+    context = {}
+    for name in names:
+        print_log("main", f"Start {name} stage.")
+        with measure("stage", name):
+            completed = stages[name](context)
+        # 各処理の所要時間とメモリ使用量はステージごとに保存し、publishステージでまとめて出力する
+        save_work_json(os.path.join("report", name + ".json"), run_report)
+        run_report.clear()
+        if not completed:
+            break
+
+
+if __name__ == '__main__':
+    stage_names = sys.argv[1:] or list(stages)
+    for stage_name in stage_names:
+        if stage_name not in stages:
+            print(f"usage: python main.py [{' | '.join(stages)} ...]")
+            sys.exit(2)
+    run_stages(stage_names)
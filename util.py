@@ -3,22 +3,99 @@ import requests
 import openpyxl
 import codecs
 import os
-import shutil
 import jaconv
 import re
+import sys
 import time
-
-from io import BytesIO
+import hashlib
+import random
+import gzip
+import tempfile
+import pickle
+import resource
+import threading
+import tracemalloc
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-from json import dumps, loads
-from datetime import datetime, timezone, timedelta
+from json import dumps, loads, JSONEncoder
+from datetime import date, datetime, timezone, timedelta
 from enum import IntEnum
-
-from typing import Union, Dict, List
-
-base_url = "https://web.pref.hyogo.lg.jp"
+from jsonschema import validators
+
+from typing import Union, Dict, List, Tuple, Optional
+
+# orjsonやbrotliは、インストールされていれば使う
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 兵庫県のサイトのURL。fixture_server.pyなど、別のサーバーから取得する場合は環境変数で指定する
+base_url = os.environ.get("COVID19_BASE_URL", "https://web.pref.hyogo.lg.jp")
+# ファイルを並列にダウンロードする際のスレッド数
+# 兵庫県のサイトに負荷をかけすぎないよう、控えめにしている
+download_workers = 4
+# 条件付きリクエスト(ETag/Last-Modified)に用いるHTTPキャッシュの保存先
+# GitHub Actionsではactions/cacheで実行間に引き継いでいる
+cache_dir = os.environ.get("COVID19_CACHE_DIR", "./cache")
+# 読み込んだシートのキャッシュの形式のバージョン。SheetTableやシートの読み込み方を変えた場合は上げて、古いキャッシュを使わせないようにする
+sheet_parser_version = 1
+# 読み込んだシートのキャッシュを、最後に使われてから消すまでの日数
+sheet_cache_days = 30
+# 現在デプロイされているjsonを、ネットワークからではなくgh-pagesブランチのチェックアウトから読む場合のディレクトリ
+now_data_dir = os.environ.get("COVID19_NOW_DATA_DIR", "")
+# 取得済みの、現在デプロイされているjson。jsonのファイル名をキーとする
+now_data_jsons = {}
+# この実行中に取得したURLとその内容のハッシュ値(SHA-256)
+# 入力ファイルに変更があったかどうかを判別するために使う
+fetched_digests = {}
 jst = timezone(timedelta(hours=9), 'JST')
 
+# jsonの出力形式
+# "default"は従来と同じインデント付きの形式、"compact"はインデントや空白のない形式(orjsonがあればそれを使う)
+json_output_profile = os.environ.get("COVID19_JSON_PROFILE", "default")
+# jsonと合わせて圧縮したファイルも出力する場合の圧縮形式。カンマ区切りで"gzip"(.gz)と"brotli"(.br)を指定できる
+json_output_compress = [c for c in os.environ.get("COVID19_JSON_COMPRESS", "").split(",") if c]
+# インデント付きのjsonを出力する際に、まとめて書き込む断片の数
+json_write_chunks = 65536
+
+# HTTP通信の設定
+# 兵庫県のサイトは読み込みが遅く、タイムアウトしやすいので、失敗した場合は間隔を指数的に伸ばしながら最大5回までリトライする
+# 接続と読み込みのタイムアウト(秒)
+http_timeout = (10, 60)
+http_max_retries = 5
+# リトライの待ち時間(秒)の基準値と上限。実際の待ち時間はジッターとしてランダムに短くする
+http_backoff_base = 2
+http_backoff_max = 60
+# 1回の実行でHTTP通信に使える時間の上限(秒)。応答のないサーバーにActionsのジョブ全体を使い切らせないようにする
+http_deadline = float(os.environ.get("COVID19_HTTP_DEADLINE", 1800))
+run_started_at = time.monotonic()
+# 接続を使い回す(keep-alive)ための共有セッション
+# ホストごとにコネクションプールを持つので、毎回TLSのハンドシェイクをし直さなくて済む
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=download_workers * 2))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=download_workers * 2))
+
+# 各処理(HTTP通信、Excelファイルの読み込み、jsonの生成や出力など)の所要時間とメモリ使用量の計測結果
+# 実行の最後にrun_report.jsonとして出力し、どの処理が遅くなったかを後から追えるようにする
+run_report = []
+run_report_lock = threading.Lock()
+# 複数のスレッドからログを出力しても行が混ざらないよう、1行ずつまとめて書き込む
+print_log_lock = threading.Lock()
+# tracemallocによるメモリ確保量の計測は処理が遅くなるので、環境変数で指定された時のみ行う
+if os.environ.get("COVID19_TRACE_MEMORY", "") == "1":
+    tracemalloc.start()
+
 SUMMARY_INIT = {
     'attr': '検査実施人数',
     'value': 0,
@@ -78,6 +155,90 @@ SUMMARY_INIT = {
 }
 
 
+class SheetTable:
+    # Excelシートの値だけを行ごとのタプルとして保持するクラス
+    # openpyxlのWorksheetはセルごとにオブジェクトを持っていてメモリを多く使い、cell()による参照も遅いので、
+    # シートは一度だけ読み込んでこのクラスに変換してから使う
+    def __init__(self, rows: List[tuple]):
+        self.rows = rows
+
+    def value(self, row: int, column: int):
+        # Worksheet.cell(row=row, column=column).valueと同じく、行と列は1から数える
+        # 範囲外のセルは空のセルと同じくNoneを返す
+        if row < 1 or column < 1:
+            return None
+        try:
+            return self.rows[row - 1][column - 1]
+        except IndexError:
+            return None
+
+    @property
+    def max_row(self) -> int:
+        return len(self.rows)
+
+    def block(self, last_row: int, last_column: int) -> List[tuple]:
+        # シートの左上からlast_row行、last_column列までの範囲を行ごとのタプルのリストとして取り出す
+        return [row[:last_column] for row in self.rows[:last_row]]
+
+    def date_index(self, column: int, first_row: int = 1, last_row: int = 0) -> Dict[date, int]:
+        # column列の日付から行番号を引くための辞書を作る
+        # シート同士を日付で突き合わせる際に、毎回シートを走査しなくて済むようにする
+        index = {}
+        for row in range(first_row, (last_row or self.max_row + 1)):
+            value = return_date(self.value(row, column))
+            if value is not None:
+                index.setdefault(value.date(), row)
+        return index
+
+
+class RollingWindow:
+    # 直近length件(7日間、14日間など)の値の合計を、値を追加するたびに差分だけ更新して保持するクラス
+    # 毎回window内の値を足し直さないので、件数によらず一件あたりO(1)で移動合計や移動平均を求められる
+    # 複数の指標(陽性数、陰性数など)をまとめて扱える
+    def __init__(self, length: int, metrics: List[str]):
+        self.length = length
+        self.metrics = metrics
+        self.values = {metric: deque() for metric in metrics}
+        self.sums = {metric: 0 for metric in metrics}
+        # 前週比などを求めるための、length件前の時点での合計
+        self.sums_history = {metric: deque() for metric in metrics}
+
+    def append(self, values: Dict) -> None:
+        for metric in self.metrics:
+            value = values[metric]
+            self.values[metric].append(value)
+            self.sums[metric] += value
+            if len(self.values[metric]) > self.length:
+                self.sums[metric] -= self.values[metric].popleft()
+            if self.is_full():
+                self.sums_history[metric].append(self.sums[metric])
+                if len(self.sums_history[metric]) > self.length + 1:
+                    self.sums_history[metric].popleft()
+
+    def is_full(self) -> bool:
+        # window内にlength件の値が揃っているかどうか
+        return len(self.values[self.metrics[0]]) == self.length
+
+    def sum(self, metric: str) -> Union[int, float]:
+        return self.sums[metric]
+
+    def average(self, metric: str) -> float:
+        return self.sums[metric] / self.length
+
+    def previous_sum(self, metric: str) -> Optional[Union[int, float]]:
+        # length件前の時点での合計(7日間のwindowなら前週の合計)を返す。まだ求められない場合はNoneを返す
+        if len(self.sums_history[metric]) <= self.length:
+            return None
+        return self.sums_history[metric][0]
+
+    def previous_ratio(self, metric: str) -> Optional[float]:
+        # 現在の合計の、length件前の時点での合計に対する比(7日間のwindowなら前週比)を返す
+        previous_sum = self.previous_sum(metric)
+        if not previous_sum:
+            return None
+        return self.sums[metric] / previous_sum
+
+
 class PatientsColumns(IntEnum):
     番号 = 2
     発表日 = 3
@@ -127,89 +288,283 @@ class MainSummaryColumns(IntEnum):
 
 
 def print_log(type: str, message: str) -> None:
-    print(f"[{datetime.now().astimezone(jst).strftime('%Y-%m-%d %H:%M:%S+09:00')}][covid19-scraping:{type}]: {message}")
+    now = datetime.now().astimezone(jst).strftime('%Y-%m-%d %H:%M:%S+09:00')
+    line = f"[{now}][covid19-scraping:{type}]: {message}\n"
+    with print_log_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def memory_usage() -> Dict:
+    # 現在までの最大RSS(KB)と、tracemallocで計測している場合は現在と最大のメモリ確保量(KB)を返す
+    usage = {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        usage["traced_kb"] = current // 1024
+        usage["traced_peak_kb"] = peak // 1024
+    return usage
+
+
+@contextmanager
+def measure(stage: str, name: str):
+    # with文で囲んだ処理の所要時間とメモリ使用量をrun_reportに記録する
+    # withで受け取った辞書に値を追加すると、それも一緒に記録される
+    # 最大RSSやtracemallocの最大値は実行中ずっと更新されるだけで戻らない(Python 3.8にはreset_peakがない)ので、
+    # 処理の前後の差分(最大RSSの増加量と、確保しているメモリの増減)を記録する
+    # 並列に実行される処理の差分には、同時に実行されている他の処理の分も含まれる
+    record = {"stage": stage, "name": name}
+    start_usage = memory_usage()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 6)
+        usage = memory_usage()
+        record["max_rss_increase_kb"] = usage["max_rss_kb"] - start_usage["max_rss_kb"]
+        if "traced_kb" in usage and "traced_kb" in start_usage:
+            record["traced_delta_kb"] = usage["traced_kb"] - start_usage["traced_kb"]
+        with run_report_lock:
+            run_report.append(record)
+
+
+def http_get(url: str, headers: Dict = None) -> requests.Response:
+    # 共有セッションを用いてGETリクエストを送る
+    # 通信エラーや5xxの場合は、指数バックオフ(ジッター付き)で待ってからリトライする
+    failed_count = 0
+    with measure("http", url) as record:
+        while True:
+            record["retries"] = failed_count
+            remaining = http_deadline - (time.monotonic() - run_started_at)
+            if remaining <= 0:
+                raise Exception(f"HTTP deadline exceeded. Can't get \"{url}\"!")
+            try:
+                res = session.get(
+                    url, headers=headers, timeout=(min(http_timeout[0], remaining), min(http_timeout[1], remaining))
+                )
+                if res.status_code < 500:
+                    record.update(status=res.status_code, bytes=len(res.content))
+                    return res
+                error = f"status code {res.status_code}"
+            except requests.RequestException as e:
+                error = e.__class__.__name__
+            if failed_count >= http_max_retries:
+                raise Exception(f"Failed get \"{url}\"! ({error})")
+            wait = min(http_backoff_max, http_backoff_base * 2 ** failed_count) * random.uniform(0.5, 1.0)
+            wait = min(wait, max(http_deadline - (time.monotonic() - run_started_at), 0))
+            print_log("http", f"Failed get \"{url}\" ({error}). retrying after {wait:.1f} seconds...")
+            failed_count += 1
+            time.sleep(wait)
+
+
+def requests_with_cache(url: str) -> Tuple[int, bytes]:
+    # キャッシュにあるETagやLast-Modifiedを送り、304(変更なし)が返ってきた場合はキャッシュの内容を使う
+    # 兵庫県のサイトは読み込みが遅いので、更新がない時にダウンロードしなくて済むだけでかなり速くなる
+    cache_name = os.path.join(cache_dir, "http", hashlib.sha256(url.encode()).hexdigest())
+    headers = {}
+    meta = {}
+    if os.path.exists(cache_name + ".json") and os.path.exists(cache_name + ".body"):
+        with open(cache_name + ".json", "r", encoding="utf-8") as f:
+            meta = loads(f.read())
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    res = http_get(url, headers=headers)
+    if res.status_code == 304 and meta:
+        with open(cache_name + ".body", "rb") as f:
+            content = f.read()
+        status_code = 200
+    else:
+        content = res.content
+        status_code = res.status_code
+        # 検証に使えるヘッダがある場合のみキャッシュする
+        if status_code == 200 and (res.headers.get("ETag") or res.headers.get("Last-Modified")):
+            os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+            with open(cache_name + ".body", "wb") as f:
+                f.write(content)
+            with open(cache_name + ".json", "w", encoding="utf-8") as f:
+                f.write(dumps({
+                    "url": url,
+                    "etag": res.headers.get("ETag"),
+                    "last_modified": res.headers.get("Last-Modified")
+                }))
+    if status_code == 200:
+        fetched_digests[url] = hashlib.sha256(content).hexdigest()
+    return status_code, content
+
+
+def file_digest(filename: str) -> str:
+    # ファイルの内容のハッシュ値(SHA-256)を返す
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_manifest() -> Dict:
+    # 前回の実行時の入力ファイルと出力ファイルのハッシュ値を記録したマニフェストを読み込む
+    filename = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r", encoding="utf-8") as f:
+        return loads(f.read())
 
 
-def get_html_soup(base: str = base_url, path: str = "/") -> BeautifulSoup:
-    # Webスクレイピングをして、ダウンロードしたいファイルのリンクを探索する
+def save_manifest(manifest: Dict) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        f.write(dumps(manifest, ensure_ascii=False, indent=4))
+
+
+def json_digest(json_data: Union[Dict, List]) -> str:
+    # キーをソートし、空白を除いた一意な形式に変換したjsonのハッシュ値(SHA-256)を返す
+    # 出力の形式(インデントなど)によらず、内容が同じであれば同じ値になる
+    canonical = dumps(json_data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def load_cached_json(file_name: str) -> Dict:
+    # キャッシュに保存しておいた前回のjsonを読み込む。存在しない場合は空の辞書を返す
+    filename = os.path.join(cache_dir, "json", file_name)
+    if not os.path.exists(filename):
+        return {}
+    with codecs.open(filename, "r", "utf-8") as f:
+        return loads(f.read())
+
+
+def save_cached_json(file_name: str, json_data: Union[Dict, List]) -> None:
+    os.makedirs(os.path.join(cache_dir, "json"), exist_ok=True)
+    with codecs.open(os.path.join(cache_dir, "json", file_name), "w", "utf-8") as f:
+        f.write(dumps(json_data, ensure_ascii=False))
+
+
+def set_action_output(name: str, value: str) -> None:
+    # GitHub Actionsで実行されている場合、後続のステップに値を渡す
+    output_file = os.environ.get("GITHUB_OUTPUT")
+    if output_file:
+        with open(output_file, "a", encoding="utf-8") as f:
+            f.write(f"{name}={value}\n")
+
+
+def get_html(base: str = base_url, path: str = "/") -> bytes:
     url = base + path
     print_log("get", f"Get html file from {url}")
-    html_doc = ""
-    # 兵庫県のサイトは読み込みが遅く、タイムアウトしやすいので、最大5回までリトライするようにしている
-    failed_count = 0
-    while not html_doc:
-        try:
-            html_doc = requests.get(url).content
-        except Exception:
-            if failed_count >= 5:
-                raise Exception(f"Failed get html file from \"{url}\"!")
-            print_log("get", f"Failed get html file from \"{url}\". retrying...")
-            failed_count += 1
-            time.sleep(5)
+    _, html_doc = requests_with_cache(url)
+    if not html_doc:
+        raise Exception(f"Failed get html file from \"{url}\"!")
+    return html_doc
+
+
+def get_html_soup(base: str = base_url, path: str = "/") -> BeautifulSoup:
+    # Webスクレイピングをして、ダウンロードしたいファイルのリンクを探索する
+    return parse_html(get_html(base, path))
+
+
+def parse_html(html_doc: bytes) -> BeautifulSoup:
     return BeautifulSoup(html_doc, "html.parser")
 
 
-def get_file(path: str, save_file: bool = False, index: int = 0) -> openpyxl.workbook.workbook.Workbook:
+def get_file_paths(path: str) -> List[str]:
+    # ページを一度だけ読み込み、そのページに含まれるExcelファイルのリンクを全て返す
     soup = get_html_soup(path=path)
 
     real_page_tags = soup.find_all("a")
 
-    file_path = ""
+    file_paths = []
     pattern = re.compile("xls[mx]?")
-    found_count = 0
     for tag in real_page_tags:
         href = tag.get("href")
         if href is not None and pattern.match(href[-4:]):
-            if index == found_count:
-                file_path = tag.get("href")
-                break
-            found_count += 1
-
-    assert file_path, "Can't get xlsx file!"
-    return requests_file(file_path, file_path[-4:], save_file)
-
-
-def requests_file(file_path: str, file_type: str, save_file: bool = False) -> openpyxl.workbook.workbook.Workbook:
+            file_paths.append(href)
+
+    assert file_paths, "Can't get xlsx file!"
+    return file_paths
+
+
+def get_file(path: str, save_dir: str, index: int = 0) -> str:
+    file_paths = get_file_paths(path)
+    assert index < len(file_paths), "Can't get xlsx file!"
+    file_path = file_paths[index]
+    return requests_file(file_path, file_path[-4:], save_dir)
+
+
+def get_files(pages: Dict[str, Union[int, None]], save_dir: str) -> Dict[str, List[str]]:
+    # pagesは{ページのパス: 先頭から取得するファイル数(Noneなら全て)}の辞書
+    # ダウンロードしたファイルはsave_dirに保存し、ページごとに保存先のパスのリストを返す
+    # 各ページは一度だけ読み込み、見つかったファイルはスレッドプールで並列にダウンロードする
+    # 兵庫県のサイトは読み込みが遅いので、直列に取得するよりも所要時間が大幅に短くなる
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        file_paths_list = list(executor.map(get_file_paths, pages.keys()))
+        futures = {}
+        for (path, limit), file_paths in zip(pages.items(), file_paths_list):
+            futures[path] = [
+                executor.submit(requests_file, file_path, file_path[-4:], save_dir)
+                for file_path in file_paths[:limit]
+            ]
+        return {path: [future.result() for future in path_futures] for path, path_futures in futures.items()}
+
+
+def load_sheet_table(file: str, sheet_index: int = 0) -> SheetTable:
+    # 読み取り専用モードでExcelファイルを開き、シートを先頭から一度だけ読んでSheetTableに変換する
+    # openpyxlでの読み込みが最も時間のかかる処理なので、読み込んだテーブルはファイルのハッシュ値をキーとしてキャッシュしておき、
+    # 内容が変わっていないファイル(過去の患者データのファイルなど)は読み込まずにキャッシュを使う
+    with measure("load_workbook", os.path.basename(file)) as record:
+        cache_name = os.path.join(
+            cache_dir, "tables", f"{file_digest(file)}-{sheet_index}-v{sheet_parser_version}.pickle"
+        )
+        record["cached"] = os.path.exists(cache_name)
+        if record["cached"]:
+            with open(cache_name, "rb") as f:
+                table = pickle.load(f)
+            # 最後に使われた日時として更新日時を更新しておく
+            os.utime(cache_name)
+        else:
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+            try:
+                sheet = workbook.worksheets[sheet_index]
+                # ファイルに記録されているシートの大きさが正しくないことがあるので、実際のデータから読み取らせる
+                sheet.reset_dimensions()
+                table = SheetTable([tuple(row) for row in sheet.iter_rows(values_only=True)])
+            finally:
+                workbook.close()
+            save_sheet_cache(cache_name, table)
+        record["rows"] = table.max_row
+    return table
+
+
+def save_sheet_cache(cache_name: str, table: SheetTable) -> None:
+    # 一時ファイルに書き込んでから置き換え、途中で失敗しても壊れたキャッシュが残らないようにする
+    # また、しばらく使われていないキャッシュは消しておく
+    directory = os.path.dirname(cache_name)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with open(fd, "wb") as f:
+            pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_filename, cache_name)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    expired_at = time.time() - sheet_cache_days * 24 * 60 * 60
+    for file_name in os.listdir(directory):
+        filename = os.path.join(directory, file_name)
+        if file_name.endswith(".pickle") and os.path.getmtime(filename) < expired_at:
+            os.remove(filename)
+
+
+def requests_file(file_path: str, file_type: str, save_dir: str) -> str:
+    # ファイルをダウンロードしてsave_dirに保存し、保存先のパスを返す
     file_url = base_url + file_path
     print_log("requests", f"Requests {file_type} file from {file_url}")
-    failed_count = 0
-    # saveフラグが立っている時はファイルを保存する。
-    if save_file:
-        status_code = 400
-        # 兵庫県のサイトは読み込みが遅く、タイムアウトしやすいので、最大5回までリトライするようにしている
-        while status_code not in [200, 404]:
-            try:
-                res = requests.get(file_url, stream=True)
-                status_code = res.status_code
-            except Exception:
-                if failed_count >= 5:
-                    raise Exception(f"Failed get {file_type} file from \"{file_url}\"!")
-                print_log("requests", f"Failed get {file_type} file from \"{file_url}\". retrying...")
-                failed_count += 1
-                time.sleep(5)
-        if status_code == 404:
-            raise Exception(f"File path has changed.({file_path})")
-        # ダウンロードしたファイルを保存
-        filename = './data/' + os.path.basename(file_url)
-        with open(filename, 'wb') as f:
-            res.raw.decode_content = True
-            shutil.copyfileobj(res.raw, f)
-        return openpyxl.load_workbook(filename, data_only=True)
-    else:
-        # ダウンロードしたものを直接binaryとしてメモリに読み込ませる。
-        # あまりよろしくないと思われるが、xlsxのような容量の小さいファイルに関しては問題ないだろう
-        file_bin = b""
-        # 兵庫県のサイトは読み込みが遅く、タイムアウトしやすいので、最大5回までリトライするようにしている
-        while not file_bin:
-            try:
-                file_bin = requests.get(file_url).content
-            except Exception:
-                if failed_count >= 5:
-                    raise Exception(f"Failed get {file_type} file from \"{file_url}\"!")
-                print_log("file", f"Failed get {file_type} file from \"{file_url}\". retrying...")
-                failed_count += 1
-                time.sleep(5)
-        return openpyxl.load_workbook(BytesIO(file_bin))
+    status_code, file_bin = requests_with_cache(file_url)
+    if status_code == 404:
+        raise Exception(f"File path has changed.({file_path})")
+    if status_code != 200 or not file_bin:
+        raise Exception(f"Failed get {file_type} file from \"{file_url}\"!")
+    filename = os.path.join(save_dir, os.path.basename(file_url))
+    with open(filename, 'wb') as f:
+        f.write(file_bin)
+    return filename
 
 
 def return_date(date: Union[datetime, int]) -> Union[datetime, None]:
@@ -236,10 +591,73 @@ def loads_json(file_name: str, path: str = "schema") -> Dict:
         return loads(f.read())
 
 
-def dumps_json(file_name: str, json_data: Union[Dict, List]) -> None:
+@lru_cache(maxsize=None)
+def get_schema_validator(file_name: str):
+    # schemaを一度だけ読み込み、schemaに書かれているdraftに対応したバリデータを作成して使い回す
+    schema = loads_json(file_name)
+    validator_class = validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+def dumps_json(file_name: str, json_data: Union[Dict, List], profile: str = "") -> None:
     # 日本語文字化け対策などを施したdump jsonキット
-    with codecs.open("./data/" + file_name, "w", "utf-8") as f:
-        f.write(dumps(json_data, ensure_ascii=False, indent=4, separators=(',', ': ')))
+    # 一時ファイルに書き込み、書き終わってから置き換えるので、途中で失敗しても中途半端なファイルが残らない
+    with measure("dumps", file_name) as record:
+        write_json(file_name, json_data, profile)
+        record["bytes"] = os.path.getsize("./data/" + file_name)
+
+
+def write_json(file_name: str, json_data: Union[Dict, List], profile: str = "") -> None:
+    profile = profile or json_output_profile
+    filename = "./data/" + file_name
+    fd, temp_filename = tempfile.mkstemp(dir="./data", prefix=f".{file_name}.", suffix=".tmp")
+    try:
+        if profile == "compact" and orjson is not None:
+            with open(fd, "wb") as f:
+                f.write(orjson.dumps(json_data))
+        else:
+            with open(fd, "w", encoding="utf-8", newline="") as f:
+                if profile == "compact":
+                    # インデントのない形式は、encodeであればCで実装されたエンコーダが使われるので速い
+                    f.write(JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode(json_data))
+                else:
+                    # インデント付きの形式は少しずつ生成されるので、ある程度まとめてから書き込む
+                    chunks = JSONEncoder(ensure_ascii=False, indent=4, separators=(',', ': ')).iterencode(json_data)
+                    while True:
+                        text = "".join(islice(chunks, json_write_chunks))
+                        if not text:
+                            break
+                        f.write(text)
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    for compression in json_output_compress:
+        dumps_compressed_file(filename, compression)
+
+
+def dumps_compressed_file(filename: str, compression: str) -> None:
+    # gh-pagesで配信するための、圧縮済みのファイルを出力する
+    with open(filename, "rb") as f:
+        content = f.read()
+    if compression == "gzip":
+        # 内容が同じであれば同じファイルになるよう、時刻は記録しない
+        compressed = gzip.compress(content, mtime=0)
+        extension = ".gz"
+    elif compression == "brotli":
+        if brotli is None:
+            print_log("dumps", "brotli is not installed. Skip brotli compression.")
+            return
+        compressed = brotli.compress(content)
+        extension = ".br"
+    else:
+        raise Exception(f"Unknown compression \"{compression}\"!")
+    with open(filename + extension, "wb") as f:
+        f.write(compressed)
 
 
 def get_weekday(day: int) -> str:
@@ -256,10 +674,49 @@ def get_numbers_in_text(text: str) -> List[int]:
 
 
 def requests_now_data_json(json_name: str) -> dict:
+    # 一度取得したjsonはnow_data_jsonsに保管しておき、二回目以降はそれを返す
+    if json_name not in now_data_jsons:
+        if now_data_dir:
+            now_data_jsons[json_name] = load_now_data_json(json_name)
+        else:
+            now_data_jsons[json_name] = fetch_now_data_json(json_name)
+    return now_data_jsons[json_name]
+
+
+def prefetch_now_data_jsons(json_names: List[str]) -> None:
+    # 現在デプロイされているjsonを並列にまとめて取得し、now_data_jsonsに保管する
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        list(executor.map(requests_now_data_json, json_names))
+
+
+def use_now_data_dir(directory: str) -> None:
+    # 以降、取得済みでないjsonはネットワークからではなく、directoryから読み込むようにする
+    global now_data_dir
+    now_data_dir = directory
+
+
+def save_now_data_jsons(directory: str) -> None:
+    # 取得済みの、現在デプロイされているjsonをdirectoryに保存する
+    os.makedirs(directory, exist_ok=True)
+    for json_name, json_data in now_data_jsons.items():
+        with open(os.path.join(directory, json_name), "w", encoding="utf-8") as f:
+            f.write(dumps(json_data, ensure_ascii=False))
+
+
+def load_now_data_json(json_name: str) -> dict:
+    # gh-pagesブランチのチェックアウトからjsonを読み込む。存在しない場合は空の辞書を返す
+    filename = os.path.join(now_data_dir, json_name)
+    if not os.path.exists(filename):
+        return {}
+    with codecs.open(filename, "r", "utf-8") as f:
+        return loads(f.read())
+
+
+def fetch_now_data_json(json_name: str) -> dict:
     try:
-        return loads(requests.get("https://stop-covid19-hyogo.github.io/covid19-scraping/" + json_name).text)
+        return loads(http_get("https://stop-covid19-hyogo.github.io/covid19-scraping/" + json_name).text)
     except Exception:
-        result = requests.get(
+        result = http_get(
             "https://raw.githubusercontent.com/stop-covid19-hyogo/covid19-scraping/gh-pages/" + json_name
         ).text
         if result == "404: Not Found":